@@ -0,0 +1,166 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library tunes the temperature controller of the SPIMMM. the heater is stepped on, in
+# heating and then in cooling mode, and a first order plus dead time model is fitted to each response, from which the
+# gains of the controller are worked out with the SIMC rules. the gains are stored as a named profile, so that a
+# sample holder only has to be tuned once. for example:
+#
+#   scope.autotune('holder2')       # about twenty minutes
+#   scope.useprofile('holder2')     # later, to reuse the gains
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# time is used to run the experiment
+# numpy is used to fit the responses
+# profiles stores the gains
+
+import time
+
+import numpy as np
+
+import profiles
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# MAXSIG - the largest heater pwm; the largest used in cooling mode is this times the cooling factor, tcf
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# fopdt - fits the gain, time constant and dead time of a first order plus dead time model to a step response
+#
+# simc - works out the gain and integral time of a PI controller for a first order plus dead time model
+#
+# gains - turns the heating and cooling models into the tkp, tkpc and tki of the controller, and the plant gains and
+# ambient temperature that its feedforward uses
+#
+# steptest - steps the heater on and records the temperature until it settles
+#
+# run - runs the heating and cooling step tests, tunes the controller and saves the profile
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+MAXSIG = 799
+
+
+# identification ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# smith's two point method: the times at which the response reaches 28.3% and 63.2% of its final change give the time
+# constant, 1.5 times their difference, and the dead time, what is left of the 63.2% time. 'step' is the change in
+# pwm; the gain is in degrees C per unit of pwm, positive for a heater that heats and a cooler that cools. returns
+# None if the response is too small to fit
+
+def fopdt(times, temps, step, minchange=0.2):
+    times = np.asarray(times, float)
+    temps = np.asarray(temps, float)
+    if len(times) < 10:
+        return None
+    tail = max(len(temps) // 10, 1)
+    start = temps[0]
+    change = float(np.mean(temps[-tail:])) - start
+    if abs(change) < minchange:
+        return None
+    progress = (temps - start) / change
+    elapsed = times - times[0]
+    t28 = elapsed[np.argmax(progress >= 0.283)]
+    t63 = elapsed[np.argmax(progress >= 0.632)]
+    tau = max(1.5 * (t63 - t28), 1e-3)
+    dead = max(t63 - tau, 0.0)
+    return {'gain': abs(change) / float(step), 'tau': float(tau), 'dead': float(dead), 'change': float(change),
+            'start': float(start)}
+
+
+# tuning ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the SIMC rules give the fastest settling that stays free of large overshoot when the closed loop time constant tc is
+# set to the dead time. the gain is in pwm per degree C and the integral time in seconds
+
+def simc(model, tc=None):
+    if tc is None:
+        tc = max(model['dead'], 0.1 * model['tau'])
+    gain = model['tau'] / (model['gain'] * (tc + model['dead']))
+    integral = min(model['tau'], 4 * (tc + model['dead']))
+    return gain, integral
+
+
+# tcalc works out signal = error * tkp + ers * tki, where ers sums error * ttc, and uses tkpc in place of tkp when
+# cooling. ers is never negative, so the integral term, and tki with it, is set from the heating model. the heating test
+# starts from the bath at rest, so its starting temperature is taken as the ambient temperature
+def gains(heat, cool, tc=None):
+    heatgain, integral = simc(heat, tc)
+    values = {'tkp': heatgain, 'tki': heatgain / integral, 'tkpc': heatgain, 'tgh': heat['gain'],
+              'amb': heat['start']}
+    if cool is not None:
+        values['tkpc'] = simc(cool, tc)[0]
+        values['tgc'] = cool['gain']
+    return values
+
+
+# experiments ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the temperatures come from the history of the heater poll. a step test ends once the temperature has stayed within
+# 'still' degrees for 'window' seconds, or after 'duration' seconds
+
+def steptest(scope, heat=True, power=400, duration=900, window=60, still=0.1):
+    scope.htm = 2 if heat else 1
+    scope.fnm = 0 if heat else 1
+    scope.hpw = power
+    start = time.time()
+    with scope.io.batch():
+        scope.sendcfg()
+        scope.sdh()
+    while time.time() - start < duration:
+        time.sleep(min(window / 4.0, 10))
+        if time.time() - start < 2 * window:
+            continue
+        recent = scope.hist.since('temp', time.time() - window)[1]
+        if len(recent) and recent.max() - recent.min() < still:
+            break
+    return scope.hist.since('temp', start)
+
+
+def run(scope, name, power=400, duration=900):
+    if scope.tempcont.isAlive():
+        print('warning: halt temperature control before tuning')
+        return None
+    if not scope.temppoll.isAlive():
+        scope.starttemppoll()
+    while not scope.data_in.isSet():
+        print('waiting for temperature poll')
+        time.sleep(0.5)
+
+    print('heating step test running')
+    heat = fopdt(*steptest(scope, True, power, duration), step=power)
+    print('cooling step test running')
+    coolpower = min(power, int(MAXSIG * scope.tcf))
+    cool = fopdt(*steptest(scope, False, coolpower, duration), step=coolpower)
+    if heat is not None and cool is not None:
+        # the cooling step starts from the heated temperature, so its change includes losing the heating
+        cool['gain'] = max(abs(cool['change']) - heat['gain'] * power, 0.0) / coolpower
+        if not cool['gain']:
+            cool = None
+
+    scope.htm = 0
+    scope.fnm = 0
+    scope.hpw = 0
+    with scope.io.batch():
+        scope.sendcfg()
+        scope.sdh()
+
+    if heat is None:
+        print('error: the temperature did not respond to the heater, nothing saved')
+        return None
+    if cool is None:
+        print('warning: the temperature did not respond to cooling, tkpc set to match tkp')
+
+    values = gains(heat, cool)
+    for key, value in values.items():
+        setattr(scope, key, value)
+    values.update({'heat': heat, 'cool': cool, 'power': power})
+    profiles.save(name, 'thermal', values)
+
+    print('heating: gain {0:.4f} C/pwm, time constant {1:.1f}s, dead time {2:.1f}s'.format(
+        heat['gain'], heat['tau'], heat['dead']))
+    if cool is not None:
+        print('cooling: gain {0:.4f} C/pwm, time constant {1:.1f}s, dead time {2:.1f}s'.format(
+            cool['gain'], cool['tau'], cool['dead']))
+    print('tkp {0:.1f}, tkpc {1:.1f}, tki {2:.3f} saved to profile {3}'.format(
+        values['tkp'], values['tkpc'], values['tki'], name))
+    return values
@@ -0,0 +1,166 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library writes logs as typed binary columns rather than lines of text. rows are
+# gathered into preallocated chunks and written by a background thread, so that logging costs the caller no more than
+# storing a few numbers, and the files can be read straight back into numpy arrays or exported as csv.
+#
+# file layout: the magic bytes SPLG, the length of the header as a uint32, the header as json, listing the name and
+# numpy type of each column, then any number of blocks. each block is the number of rows it holds as a uint32 followed
+# by each column in turn, packed
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# collections keeps the columns in order
+# json is used for the file header
+# struct is used for the block sizes
+# threading runs the writer
+# time is used for the flush period
+# numpy holds the chunks and reads the files back
+
+import collections
+import json
+import struct
+import threading
+import time
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# TEMPCOLUMNS - the columns of a temperature log: the time the sample arrived, the measured temperature, the setpoint,
+# the heater pwm and the heater mode
+#
+# objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# ColumnLog - a log file open for appending rows
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# read - reads a log into an ordered dictionary of numpy arrays, one per column
+#
+# tocsv - exports a log as a csv file with a header line of column names
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+MAGIC = b'SPLG'
+
+SIZE = struct.Struct('<I')
+
+PRECISION = {'<f8': '%.6f', '<f4': '%.3f'}
+
+TEMPCOLUMNS = (('time', '<f8'), ('temp', '<f4'), ('tem', '<f4'), ('pwm', '<i2'), ('mode', '<i2'))
+
+
+# writer ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# chunk is the number of rows held before a block is handed to the writer, and period the longest time in seconds that
+# rows are held before being written, so a crash loses at most that much of the log. full chunks are replaced by new
+# ones rather than copied
+
+class ColumnLog:
+
+    def __init__(self, path, columns=TEMPCOLUMNS, chunk=4096, period=10.0):
+        self.path = path
+        self.columns = tuple((name, np.dtype(kind)) for name, kind in columns)
+        self.chunk = chunk
+        self.period = period
+        self.lock = threading.Lock()
+        self.blocks = queue.Queue()
+        self.rows = 0
+        self.written = 0
+        self.new()
+        self.file = open(path, 'wb')
+        header = json.dumps([[name, kind.str] for name, kind in self.columns]).encode('ascii')
+        self.file.write(MAGIC + SIZE.pack(len(header)) + header)
+        self.thread = threading.Thread(name='binlog', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new(self):
+        self.data = [np.empty(self.chunk, kind) for name, kind in self.columns]
+        self.fill = 0
+        self.started = time.time()
+
+    # values are given in the order of the columns
+    def append(self, *values):
+        with self.lock:
+            row = self.fill
+            for column, value in zip(self.data, values):
+                column[row] = value
+            self.fill += 1
+            self.rows += 1
+            if self.fill == self.chunk:
+                self.handoff()
+
+    def handoff(self):
+        # called with the lock held
+        if self.fill:
+            self.blocks.put((self.data, self.fill))
+            self.new()
+
+    def run(self):
+        while True:
+            try:
+                block = self.blocks.get(timeout=self.period)
+            except queue.Empty:
+                with self.lock:
+                    if time.time() - self.started >= self.period:
+                        self.handoff()
+                continue
+            if block is None:
+                break
+            self.write(*block)
+
+    def write(self, data, count):
+        self.file.write(SIZE.pack(count))
+        for column in data:
+            self.file.write(column[:count].tobytes())
+        self.file.flush()
+        self.written += count
+
+    def close(self):
+        with self.lock:
+            self.handoff()
+        self.blocks.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+# reader ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# a block cut short by a crash is ignored
+
+def read(path):
+    with open(path, 'rb') as logfile:
+        raw = logfile.read()
+    if raw[:len(MAGIC)] != MAGIC:
+        raise ValueError(path + ' is not a column log')
+    start = len(MAGIC) + SIZE.size
+    length = SIZE.unpack_from(raw, len(MAGIC))[0]
+    columns = [(str(name), np.dtype(str(kind))) for name, kind in json.loads(raw[start:start + length].decode('ascii'))]
+    width = sum(kind.itemsize for name, kind in columns)
+    parts = dict((name, []) for name, kind in columns)
+    offset = start + length
+    while offset + SIZE.size <= len(raw):
+        count = SIZE.unpack_from(raw, offset)[0]
+        offset += SIZE.size
+        if offset + count * width > len(raw):
+            break
+        for name, kind in columns:
+            parts[name].append(np.frombuffer(raw, kind, count, offset))
+            offset += count * kind.itemsize
+    return collections.OrderedDict((name, np.concatenate(parts[name]) if parts[name] else np.empty(0, kind))
+                                   for name, kind in columns)
+
+
+# times are written to the microsecond and other floats to three places, which is all a float32 holds
+def tocsv(path, out):
+    data = read(path)
+    names = list(data.keys())
+    formats = [PRECISION.get(data[name].dtype.str, '%d') for name in names]
+    np.savetxt(out, np.column_stack([data[name] for name in names]), fmt=formats, delimiter=',',
+               header=','.join(names), comments='')
@@ -0,0 +1,154 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library encodes and decodes the binary frames that can be used in place of the ascii
+# commands for SET, RDH, DAC, STA and QRP. a frame is fixed in size for each command and carries its own length and
+# checksum, so that corrupted frames are caught rather than parsed.
+#
+# frame layout: sync (0xA5), opcode, payload length, payload (little endian, packed), checksum
+# the checksum is chosen so that the opcode, length, payload and checksum bytes sum to zero modulo 256. a response has
+# the opcode of its command with the top bit set. stage positions are sent as whole nanometres.
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# struct is used to pack and unpack the payloads
+
+import struct
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# SYNC - the first byte of every frame, which never appears in the ascii protocol
+#
+# REPLY - the bit that is set in the opcode of a response
+#
+# SET, RDH, DAC, STA, QRP - the opcodes of the commands
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# encode - packs one frame
+#
+# encodemany - packs a list of frames into one buffer
+#
+# decode - unpacks every complete frame at the start of a buffer
+#
+# decodeone - unpacks the frame at a given position in a buffer
+#
+# missing - the number of bytes still needed to complete the frame at the start of a buffer
+#
+# tonm / tomm - convert stage positions between mm and whole nanometres
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SYNC = 0xA5
+
+REPLY = 0x80
+
+SET = 0x01
+
+RDH = 0x02
+
+DAC = 0x03
+
+STA = 0x04
+
+QRP = 0x05
+
+NAMES = {SET: 'SET', RDH: 'RDH', DAC: 'DAC', STA: 'STA', QRP: 'QRP'}
+
+# the SET payload follows the order of spimmm_obj.CFGFIELDS:
+# smt frt exp htm hpw fnm cur1 cur2 cur3 cur4 led slp off dup dlo ste camera2 num_frame frame_period
+# the RDH response is the heater mode, pwm and temperature
+FORMATS = {
+    SET: struct.Struct('<HHHBHBhhhhHfifffBHH'),
+    RDH: struct.Struct('<'),
+    DAC: struct.Struct('<H'),
+    STA: struct.Struct('<i'),
+    QRP: struct.Struct('<'),
+    RDH | REPLY: struct.Struct('<BHf'),
+    QRP | REPLY: struct.Struct('<i'),
+}
+
+HEADER = struct.Struct('<BBB')
+
+
+# conversions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def tonm(position):
+    return int(round(position * 1e6))
+
+
+def tomm(position):
+    return position * 1e-6
+
+
+def cast(fmt, values):
+    # floats go out as they are, everything else is rounded to a whole number
+    codes = fmt.format.lstrip('<')
+    return [float(value) if code == 'f' else int(round(float(value))) for code, value in zip(codes, values)]
+
+
+# encode ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def encode(op, values=()):
+    fmt = FORMATS[op]
+    payload = fmt.pack(*cast(fmt, values))
+    frame = bytearray(HEADER.pack(SYNC, op, len(payload)))
+    frame += payload
+    frame.append((-sum(frame[1:])) & 0xFF)
+    return bytes(frame)
+
+
+def encodemany(frames):
+    return b''.join(encode(op, values) for op, values in frames)
+
+
+# decode ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def missing(buf):
+    if len(buf) < HEADER.size:
+        return HEADER.size - len(buf)
+    return max(HEADER.size + bytearray(buf[2:3])[0] + 1 - len(buf), 0)
+
+
+# unpacks the frame that starts at 'start', without copying the buffer. returns the (opcode, values) frame and the index
+# after it. a frame that is not complete before 'end' returns None and 'start'; a corrupt one returns None and the index
+# after its sync byte
+def decodeone(buf, start=0, end=None):
+    if end is None:
+        end = len(buf)
+    if end - start < HEADER.size:
+        return None, start
+    sync, op, length = HEADER.unpack_from(buf, start)
+    stop = start + HEADER.size + length + 1
+    if stop > end:
+        return None, start
+    fmt = FORMATS.get(op)
+    if sync != SYNC or sum(bytearray(buf[start + 1:stop])) & 0xFF or fmt is None or fmt.size != length:
+        return None, start + 1
+    return (op, fmt.unpack_from(buf, start + HEADER.size)), stop
+
+
+# returns the list of (opcode, values) frames, the number of bytes used and the number of corrupt frames. bytes before a
+# sync byte are skipped as corrupt, and an incomplete frame at the end of the buffer is left for the next call
+def decode(buf, start=0, end=None):
+    if not isinstance(buf, bytearray):
+        buf = bytearray(buf)
+    if end is None:
+        end = len(buf)
+    frames = []
+    errors = 0
+    while start < end:
+        if buf[start] != SYNC:
+            errors += 1
+            nxt = buf.find(bytearray([SYNC]), start, end)
+            start = end if nxt < 0 else nxt
+            continue
+        frame, nxt = decodeone(buf, start, end)
+        if nxt == start:
+            break
+        if frame is None:
+            errors += 1
+        else:
+            frames.append(frame)
+        start = nxt
+    return frames, start, errors
@@ -0,0 +1,83 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library calibrates the mirror against the stage. at each of a few stage positions the
+# mirror count that brings the sample into focus is recorded, and a straight line is fitted to the pairs by least
+# squares to give slp and posadj, so that SPIMMM.stm keeps the sample in focus as the stage moves. the fit and its
+# residuals are stored as a named profile for each objective and sample holder, so that a calibration is made once and
+# then loaded when the SPIMMM starts. for example:
+#
+#   scope.focus(6.0); scope.mirror(3950); scope.calpoint()     # at each of a few positions, once in focus
+#   scope.makecal('10x', 'holder2')
+#   scope = spimmm_obj.SPIMMM(profile=calib.name('10x', 'holder2'))    # later
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# numpy fits the calibration
+# profiles stores it
+
+import numpy as np
+
+import profiles
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# MAXDAC - the largest mirror count, which stm gives at posadj
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# name - the name of the profile of an objective and sample holder
+#
+# fit - fits slp and posadj to stage positions and mirror counts, and gives the residuals
+#
+# run - fits the points recorded by a SPIMMM, puts the calibration in use and saves the profile
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+MAXDAC = 4095
+
+
+def name(objective, holder):
+    return str(objective) + '_' + str(holder)
+
+
+# fitting ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# stm gives count = (position - posadj) * slp + MAXDAC, a straight line of slope slp that reaches MAXDAC at posadj, so
+# fitting count = slope * position + intercept gives slp = slope and posadj = (MAXDAC - intercept) / slope. the
+# residuals are the counts found less those of the line. returns None if the positions do not span a line
+
+def fit(positions, counts):
+    positions = np.asarray(positions, float)
+    counts = np.asarray(counts, float)
+    if len(np.unique(positions)) < 2:
+        return None
+    design = np.column_stack((positions, np.ones(len(positions))))
+    (slope, intercept), found, rank, values = np.linalg.lstsq(design, counts, rcond=None)
+    if slope == 0:
+        return None
+    residuals = counts - design.dot((slope, intercept))
+    return {'slp': float(slope), 'posadj': float((MAXDAC - intercept) / slope), 'points': len(positions),
+            'residuals': residuals.tolist(), 'rms': float(np.sqrt(np.mean(residuals ** 2))),
+            'worst': float(np.abs(residuals).max())}
+
+
+# calibration ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the points are the (stage position, mirror count) pairs in the SPIMMM's cpt
+
+def run(scope, objective, holder):
+    positions = [position for position, count in scope.cpt]
+    counts = [count for position, count in scope.cpt]
+    values = fit(positions, counts)
+    if values is None:
+        print('error: at least two stage positions are needed to calibrate, nothing saved')
+        return None
+    print('{0:>10} {1:>6} {2:>9}'.format('position', 'count', 'residual'))
+    for position, count, residual in zip(positions, counts, values['residuals']):
+        print('{0:>10.4f} {1:>6} {2:>9.1f}'.format(position, count, residual))
+    print('slp {0:.3f}, posadj {1:.4f}; residuals rms {2:.1f}, worst {3:.1f} counts'.format(
+        values['slp'], values['posadj'], values['rms'], values['worst']))
+    scope.setcal(values['slp'], values['posadj'])
+    values.update({'positions': positions, 'counts': counts, 'objective': objective, 'holder': holder})
+    profiles.save(name(objective, holder), 'focus', values)
+    print('calibration saved to profile ' + name(objective, holder))
+    return values
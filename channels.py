@@ -0,0 +1,89 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library interleaves several channels, each a camera and a set of lasers, in one
+# acquisition. the order of the channels is worked out in advance, and so are the laser commands that switch from any
+# channel to any other, so that a switch only writes the lasers that change, turning them on or off, and never sets
+# their power again. the frames taken on each channel are counted so that the rate each achieved can be reported.
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# threading is used to guard the counts, which are read from other threads
+# numpy works out the order of the channels
+# timing is the clock the rates are measured on
+
+import threading
+
+import numpy as np
+
+import timing
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# ChannelStats - the frames taken on each channel and the rate achieved
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# order - the channel of each of a number of frames or volumes, taking the channels in turn
+#
+# switch - the commands for each laser that change its state from one channel to another
+#
+# switches - switch for every pair of channels, and from no channel to each one
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+# schedule ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# 'each' is the number of frames or volumes taken on a channel before moving to the next
+
+def order(count, channels, each=1):
+    return (np.arange(count) // each) % channels
+
+
+# the states are tuples with the on or off state of each laser. before is None when the lasers are in an unknown
+# state, in which case every laser is written. returns a command string for each laser, empty if it is left as it is
+def switch(before, after):
+    cmds = []
+    for laser, state in enumerate(after):
+        if before is not None and before[laser] == state:
+            cmds.append('')
+        else:
+            cmds.append('SOUR:AM:STAT ON\r' if state else 'SOUR:AM:STAT OFF\r')
+    return tuple(cmds)
+
+
+# keyed by the indices of the channels before and after, with None before for the first
+def switches(states):
+    table = {}
+    for after, state in enumerate(states):
+        table[None, after] = switch(None, state)
+        for before, previous in enumerate(states):
+            table[before, after] = switch(previous, state)
+    return table
+
+
+# statistics ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the rate of a channel is its frames over the time since the acquisition started
+
+class ChannelStats:
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.lock = threading.Lock()
+        self.frames = dict((name, 0) for name in self.names)
+        self.start = timing.clock()
+        self.last = self.start
+
+    def add(self, name, frames=1):
+        with self.lock:
+            self.frames[name] += frames
+            self.last = timing.clock()
+
+    def rate(self, name):
+        with self.lock:
+            elapsed = self.last - self.start
+            return self.frames[name] / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        return '\n'.join('{0}: {1} frames, {2:.2f} frames/s'.format(name, self.frames[name], self.rate(name))
+                         for name in self.names)
@@ -0,0 +1,509 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library emulates the arduino and the two coherent lasers so that the software can be
+# run, measured and regression tested without the rig. each device sits behind a pty or a tcp socket, so that the
+# SPIMMM class can be pointed at it with a device path or a pyserial 'socket://' url in place of the COM port.
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# os and tty are used to create the pseudo terminals
+# socket is used to serve the devices over tcp
+# threading is used to run each device alongside the host software
+# time is used to model latency, throughput and the physical state of the hardware
+# spimmm_obj holds the order of the configuration parameters
+# binproto encodes and decodes the binary frames
+
+import os
+import socket
+import threading
+import time
+
+import binproto
+from spimmm_obj import CFGFIELDS
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# ThermalModel - first order model of the peltier and the sample bath
+#
+# StageModel - model of the PI stage that takes a finite time to reach its target in slow and fast mode
+#
+# Device - base class that runs commands one at a time with a configurable latency per command. binary frames are
+# counted and delayed under the name of the ascii command they stand for
+#
+# ArduinoEmulator - speaks the arduino protocol: SET, CFG, REP, RUN, RUNM, RDH, STH, QRP, DAC, STA, STS, FRM, STM...
+#
+# LaserEmulator - speaks the SCPI subset that is sent to the coherent lasers
+#
+# Link - carries bytes between a device and the host over a pty or a socket, limited to the throughput of the baud rate
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# start_rig - starts an arduino and two lasers and returns the ports to pass to SPIMMM
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# thermal model ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class ThermalModel:
+    # amb is the ambient temperature, tau the time constant of the bath in seconds, heat and cool the rate of change
+    # of temperature in degrees per second at full power, and fan the fraction of the cooling that is lost when the fan
+    # is off
+
+    def __init__(self, temp=21.0, amb=21.0, tau=300.0, heat=0.05, cool=0.03, fan=0.5):
+        self.temp = temp
+        self.amb = amb
+        self.tau = tau
+        self.heat = heat
+        self.cool = cool
+        self.fan = fan
+        self.htm = 0
+        self.hpw = 0.0
+        self.fnm = 0
+        self.last = time.time()
+
+    def rate(self):
+        drive = min(abs(self.hpw), 799.0) / 799.0
+        rate = (self.amb - self.temp) / self.tau
+        if self.htm == 2:
+            rate += self.heat * drive
+        elif self.htm == 1:
+            if self.fnm:
+                rate -= self.cool * drive
+            else:
+                rate -= self.cool * drive * (1.0 - self.fan)
+        return rate
+
+    def step(self, dt):
+        # integrate in steps of at most a second so that long gaps between reads stay stable
+        while dt > 0:
+            h = min(dt, 1.0)
+            self.temp += self.rate() * h
+            dt -= h
+
+    def advance(self, now=None):
+        if now is None:
+            now = time.time()
+        self.step(now - self.last)
+        self.last = now
+
+    def apply(self, htm, hpw, fnm):
+        self.advance()
+        self.htm = int(htm)
+        self.hpw = float(hpw)
+        self.fnm = int(fnm)
+
+
+# stage model ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# a move in fast mode (STA) takes a settling time plus a travel time, a move in slow mode (STS) takes at least 2.5s
+
+class StageModel:
+
+    def __init__(self, pos=0.0, settle=0.02, speed=1.0, slow_settle=2.5, slow_speed=0.5):
+        self.start = pos
+        self.target = pos
+        self.settle = settle
+        self.speed = speed
+        self.slow_settle = slow_settle
+        self.slow_speed = slow_speed
+        self.t0 = time.time()
+        self.duration = 0.0
+
+    def move(self, target, slow=False):
+        now = time.time()
+        self.start = self.position(now)
+        self.target = float(target)
+        distance = abs(self.target - self.start)
+        if slow:
+            self.duration = self.slow_settle + distance / self.slow_speed
+        else:
+            self.duration = self.settle + distance / self.speed
+        self.t0 = now
+
+    def position(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.duration <= 0:
+            return self.target
+        fraction = (now - self.t0) / self.duration
+        if fraction >= 1.0:
+            return self.target
+        return self.start + (self.target - self.start) * max(fraction, 0.0)
+
+    def halt(self):
+        self.target = self.position()
+        self.start = self.target
+        self.duration = 0.0
+
+
+# device base class ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# commands are run one at a time, as on the real hardware, each after its latency in seconds. latency is a dictionary
+# keyed by the command name, anything not in it waits for the default latency
+
+class Device:
+    startup = b''
+
+    def __init__(self, latency=None, default_latency=0.0005):
+        self.latency = dict(latency or {})
+        self.default_latency = default_latency
+        self.counts = {}
+        self.inbox = queue.Queue()
+        self.send = None
+        self.worker = threading.Thread(name=self.__class__.__name__, target=self.run)
+        self.worker.daemon = True
+
+    def attach(self, send):
+        self.send = send
+        if not self.worker.is_alive():
+            self.worker.start()
+        if self.startup:
+            self.send(self.startup)
+
+    def feed(self, line):
+        self.inbox.put(line)
+
+    def run(self):
+        while True:
+            line = self.inbox.get()
+            if line is None:
+                return
+            if isinstance(line, tuple):
+                op, values = line
+                cmd = binproto.NAMES[op]
+            else:
+                line = line.strip()
+                if not line:
+                    continue
+                cmd = line.split()[0]
+            self.counts[cmd] = self.counts.get(cmd, 0) + 1
+            time.sleep(self.latency.get(cmd, self.default_latency))
+            try:
+                if isinstance(line, tuple):
+                    resps = self.handleframe(op, values)
+                else:
+                    resps = self.handle(cmd, line.split()[1:])
+                for resp in resps:
+                    self.send(resp if isinstance(resp, bytes) else resp.encode('ascii'))
+            except (ValueError, IndexError):
+                # malformed commands are ignored, as they are by the firmware
+                pass
+
+    def handle(self, cmd, args):
+        return []
+
+    def handleframe(self, op, values):
+        return []
+
+    def stop(self):
+        self.inbox.put(None)
+
+
+# arduino ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class ArduinoEmulator(Device):
+    startup = b'SPIMMM arduino ready\n'
+
+    def __init__(self, latency=None, default_latency=0.0005, thermal=None, stage=None):
+        Device.__init__(self, latency, default_latency)
+        self.thermal = thermal or ThermalModel()
+        self.stage = stage or StageModel()
+        self.cfg = dict((field, 0) for field in CFGFIELDS)
+        self.dac = 0
+        self.frames = 0
+        self.volumes = 0
+        self.trig = 0
+        self.cur = [0, 0, 0, 0]
+        self.led = 0
+
+    def voltime(self):
+        # a volume takes one frame period per slice of the stack
+        ste = float(self.cfg['ste']) or 1.0
+        slices = int(round(abs(float(self.cfg['dup']) - float(self.cfg['dlo'])) / ste)) + 1
+        return slices * 0.001 * float(self.cfg['frt'])
+
+    def heater(self):
+        self.thermal.advance()
+        return '$HC,MODE,{0},PWM,{1},TEMP,{2:.2f},END\n'.format(self.thermal.htm, int(self.thermal.hpw),
+                                                                self.thermal.temp)
+
+    def magnet(self):
+        return '$MC,CUR1,{0},CUR2,{1},CUR3,{2},CUR4,{3},TRIG,{4},LED,{5},END\n'.format(
+            self.cur[0], self.cur[1], self.cur[2], self.cur[3], self.trig, self.led)
+
+    def handle(self, cmd, args):
+        if cmd == 'SET':
+            for field, value in zip(CFGFIELDS, args):
+                self.cfg[field] = float(value)
+            return []
+        if cmd == 'CFG':
+            pairs = list(zip(args[0::2], args[1::2]))
+            if len(args) % 2 or any(field not in self.cfg for field, value in pairs):
+                return ['$CF,ERR,END\n']
+            for field, value in pairs:
+                self.cfg[field] = float(value)
+            return ['$CF,{0},END\n'.format(len(pairs))]
+        if cmd == 'REP':
+            return ['{0} {1}\n'.format(field, self.cfg[field]) for field in CFGFIELDS] + ['END\n']
+        if cmd == 'STH':
+            self.thermal.apply(self.cfg['htm'], self.cfg['hpw'], self.cfg['fnm'])
+            return []
+        if cmd == 'RDH':
+            return [self.heater()]
+        if cmd == 'DAC':
+            self.dac = int(args[0])
+            return []
+        if cmd in ('STA', 'STS'):
+            self.stage.move(float(args[0]), slow=(cmd == 'STS'))
+            return []
+        if cmd == 'QRP':
+            return ['{0:.6f}\n'.format(self.stage.position())]
+        if cmd == 'STP':
+            self.stage.halt()
+            return []
+        if cmd == 'ERR':
+            return ['stage error 0\n', 'error cleared\n']
+        if cmd == 'FRM':
+            self.frames += 1
+            time.sleep(0.001 * int(args[1]))
+            return []
+        if cmd == 'RUN':
+            time.sleep(self.voltime())
+            self.volumes += 1
+            return ['$VL,{0},END\n'.format(self.volumes)]
+        if cmd == 'RUNM':
+            resps = []
+            for n in range(max(int(self.cfg['num_frame']), 1)):
+                time.sleep(self.voltime())
+                self.volumes += 1
+                resps.append('$VL,{0},END\n'.format(self.volumes))
+            return resps
+        if cmd == 'STM':
+            self.cur = [int(self.cfg['cur1']), int(self.cfg['cur2']), int(self.cfg['cur3']), int(self.cfg['cur4'])]
+            return []
+        if cmd == 'LON':
+            self.led = int(self.cfg['led'])
+            return []
+        if cmd == 'RDM':
+            return [self.magnet()]
+        if cmd == 'TRS':
+            self.trig = 1
+            return []
+        if cmd == 'KLS':
+            self.trig = 0
+            return []
+        return []
+
+
+    def handleframe(self, op, values):
+        if op == binproto.SET:
+            for field, value in zip(CFGFIELDS, values):
+                self.cfg[field] = float(value)
+            return []
+        if op == binproto.RDH:
+            self.thermal.advance()
+            return [binproto.encode(binproto.RDH | binproto.REPLY,
+                                    [self.thermal.htm, self.thermal.hpw, self.thermal.temp])]
+        if op == binproto.DAC:
+            self.dac = values[0]
+            return []
+        if op == binproto.STA:
+            self.stage.move(binproto.tomm(values[0]))
+            return []
+        if op == binproto.QRP:
+            return [binproto.encode(binproto.QRP | binproto.REPLY, [binproto.tonm(self.stage.position())])]
+        return []
+
+
+# lasers ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# only queries (ending in '?') are answered, the host does not read back the response to a setting
+
+class LaserEmulator(Device):
+
+    def __init__(self, wavelength, latency=None, default_latency=0.002):
+        Device.__init__(self, latency, default_latency)
+        self.wavelength = wavelength
+        self.power = 0.0
+        self.state = False
+        self.internal = False
+
+    def handle(self, cmd, args):
+        if cmd == 'SOUR:POW:LEV:IMM:AMPL':
+            self.power = float(args[0])
+        elif cmd == 'SOUR:AM:STAT':
+            self.state = args[0].upper() == 'ON'
+        elif cmd == 'SOUR:AM:INT':
+            self.internal = True
+        elif cmd == 'SOUR:POW:LEV:IMM:AMPL?':
+            return ['{0}\n'.format(self.power)]
+        elif cmd == 'SOUR:AM:STAT?':
+            return ['ON\n' if self.state else 'OFF\n']
+        elif cmd == 'SYST:WAV?':
+            return ['{0}\n'.format(self.wavelength)]
+        return []
+
+
+# transport ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# baudrate limits the throughput in both directions to ten bits per byte, as on the uart. None disables the limit
+
+class Link:
+
+    def __init__(self, device, baudrate=115200):
+        self.device = device
+        self.baudrate = baudrate
+        self.writelock = threading.Lock()
+        self.fd = None
+        self.conn = None
+        self.corrupt = 0
+        self.server = None
+        self.thread = None
+        self.halt = threading.Event()
+
+    def bytetime(self, n):
+        if not self.baudrate:
+            return 0.0
+        return 10.0 * n / self.baudrate
+
+    def send(self, data):
+        with self.writelock:
+            time.sleep(self.bytetime(len(data)))
+            if self.fd is not None:
+                os.write(self.fd, data)
+            elif self.conn is not None:
+                try:
+                    self.conn.sendall(data)
+                except socket.error:
+                    pass
+
+    def receive(self, buf, data):
+        time.sleep(self.bytetime(len(data)))
+        buf += data
+        while True:
+            if buf[:1] == bytes(bytearray([binproto.SYNC])):
+                # a binary frame, which is passed on once it is complete. corrupt frames are dropped
+                if binproto.missing(buf):
+                    return buf
+                size = binproto.HEADER.size + bytearray(buf[2:3])[0] + 1
+                frames, used, errors = binproto.decode(buf[:size])
+                buf = buf[size:]
+                self.corrupt += errors
+                for frame in frames:
+                    self.device.feed(frame)
+                continue
+            end = -1
+            for term in (b'\r', b'\n'):
+                index = buf.find(term)
+                if index >= 0 and (end < 0 or index < end):
+                    end = index
+            if end < 0:
+                return buf
+            line = buf[:end]
+            buf = buf[end + 1:]
+            self.device.feed(line.decode('ascii', 'replace'))
+
+    # serve over a pseudo terminal, returning the device path to open on the host
+    def serve_pty(self):
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self.fd = master
+        self.slave = slave
+        self.thread = threading.Thread(name='link', target=self.actpty)
+        self.thread.daemon = True
+        self.thread.start()
+        self.device.attach(self.send)
+        return os.ttyname(slave)
+
+    def actpty(self):
+        buf = b''
+        while not self.halt.isSet():
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buf = self.receive(buf, data)
+
+    # serve over tcp, returning the pyserial url to open on the host. one host connection is served at a time
+    def serve_socket(self, host='localhost', port=0):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.thread = threading.Thread(name='link', target=self.actsocket)
+        self.thread.daemon = True
+        self.thread.start()
+        return 'socket://{0}:{1}'.format(host, self.server.getsockname()[1])
+
+    def actsocket(self):
+        while not self.halt.isSet():
+            try:
+                conn, address = self.server.accept()
+            except socket.error:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.conn = conn
+            self.device.attach(self.send)
+            buf = b''
+            while not self.halt.isSet():
+                try:
+                    data = conn.recv(4096)
+                except socket.error:
+                    break
+                if not data:
+                    break
+                buf = self.receive(buf, data)
+            self.conn = None
+            conn.close()
+
+    def close(self):
+        self.halt.set()
+        self.device.stop()
+        if self.server is not None:
+            self.server.close()
+        if self.conn is not None:
+            self.conn.close()
+        if self.fd is not None:
+            os.close(self.fd)
+            os.close(self.slave)
+
+
+# start the whole rig ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# returns the links and a dictionary of ports that can be passed straight to SPIMMM, e.g.
+#   links, ports = emulator.start_rig()
+#   scope = spimmm_obj.SPIMMM(**ports)
+
+def start_rig(transport='socket', latency=None, baudrate=115200, thermal=None, stage=None):
+    ard = Link(ArduinoEmulator(latency, thermal=thermal, stage=stage), baudrate)
+    las1 = Link(LaserEmulator(488), 9600)
+    las2 = Link(LaserEmulator(561), 9600)
+    links = {'ard': ard, 'las1': las1, 'las2': las2}
+    ports = {}
+    for name in ('ard', 'las1', 'las2'):
+        if transport == 'pty':
+            ports[name + '_port'] = links[name].serve_pty()
+        else:
+            ports[name + '_port'] = links[name].serve_socket()
+    return links, ports
+
+
+def stop_rig(links):
+    for link in links.values():
+        link.close()
+
+
+if __name__ == '__main__':
+    import sys
+    rig, urls = start_rig(sys.argv[1] if len(sys.argv) > 1 else 'socket')
+    for key in sorted(urls):
+        print(key + ': ' + urls[key])
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_rig(rig)
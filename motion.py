@@ -0,0 +1,177 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library calibrates how long the stage takes to move. a sweep of moves of different
+# lengths is made in each mode, fast (STA) and slow (STS), and the stage position is polled with QRP until each move has
+# settled. the worst time seen at each distance, with a margin, is kept as a lookup table for that mode, and is used to
+# choose the mode of a move and how long to wait for it. the tables are stored as a named profile. for example:
+#
+#   scope.calibratemotion('stage1')     # a few minutes, most of it in slow moves
+#   scope.useprofile('stage1')          # later, to reuse the tables
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# json is used to make a key of the tables for caching
+# time is used to time the moves
+# numpy fits and looks up the tables
+# profiles stores the tables
+
+import json
+import time
+
+import numpy as np
+
+import profiles
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# MODES - the move commands of the stage, fast and slow
+#
+# DISTANCES - the lengths of the moves of the sweep in mm
+#
+# MARGIN - the factor the worst time seen at each distance is multiplied by
+#
+# MAXPOS - the furthest the stage may be sent from zero, in mm
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# settle - makes one move and returns the time it took to settle
+#
+# sweep - makes moves of each distance in each mode and returns the distances and times
+#
+# fit - turns the distances and times of one mode into its table
+#
+# movetime - looks up the time a move takes in a table
+#
+# choose - the mode to make a move in, the faster of those that have been calibrated for its distance, or None if
+#          neither has
+#
+# key - a string that stands for a set of tables, for caching plans made with them
+#
+# run - runs the sweep, fits the tables and saves the profile
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+MODES = ('STA', 'STS')
+
+DISTANCES = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+
+MARGIN = 1.2
+
+MAXPOS = 6.495
+
+
+# measurement ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# a move has settled once 'still' polls in a row read within 'tol' mm of the target; the time is that of the first of
+# them. returns None if the move does not settle within the timeout
+
+def settle(scope, target, mode, tol=0.0005, still=2, timeout=10.0):
+    target = round(target, 6)
+    scope.send(mode + ' ' + str(target))
+    start = time.time()
+    arrived = None
+    count = 0
+    while time.time() - start < timeout:
+        pos = scope.get_pos()
+        if abs(pos - target) <= tol:
+            if arrived is None:
+                arrived = time.time()
+            count += 1
+            if count >= still:
+                return arrived - start
+        else:
+            arrived = None
+            count = 0
+    return None
+
+
+# each distance is moved out from the position the stage starts at and back, 'repeats' times. returns a dictionary of
+# the distances and times of each mode; moves that did not settle are left out
+def sweep(scope, distances=DISTANCES, modes=MODES, repeats=3):
+    centre = scope.get_pos()
+    results = {}
+    for mode in modes:
+        found = []
+        for distance in distances:
+            target = centre + distance if abs(centre + distance) <= MAXPOS else centre - distance
+            for repeat in range(repeats):
+                for end in (target, centre):
+                    took = settle(scope, end, mode)
+                    if took is None:
+                        print('warning: ' + mode + ' move of ' + str(distance) + 'mm did not settle')
+                    else:
+                        found.append((distance, took))
+        results[mode] = ([distance for distance, took in found], [took for distance, took in found])
+    return results
+
+
+# tables ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# a table holds the distances in mm and the worst time seen at each in seconds, times the margin. between them the time
+# is interpolated, below the shortest it is that of the shortest, and beyond the longest it grows at the slope of a
+# straight line fitted to the longer half of the moves, where the travel rather than the settling takes the time. a mode
+# is only chosen for distances up to the longest it was calibrated at
+
+def fit(distances, times, margin=MARGIN):
+    distances = np.asarray(distances, float)
+    times = np.asarray(times, float)
+    if not len(distances):
+        return None
+    steps = np.unique(distances)
+    worst = np.array([times[distances == step].max() for step in steps]) * margin
+    # with a single distance, longer moves are taken to grow in proportion to it
+    longer = distances >= steps[(len(steps) - 1) // 2]
+    slope = np.polyfit(distances[longer], times[longer], 1)[0] if len(steps) > 1 else worst[0] / steps[0]
+    return {'distance': steps.tolist(), 'time': worst.tolist(), 'slope': max(float(slope), 0.0)}
+
+
+def movetime(table, distance):
+    distance = np.abs(np.asarray(distance, float))
+    known = np.asarray(table['distance'])
+    times = np.asarray(table['time'])
+    beyond = times[-1] + table['slope'] * (distance - known[-1])
+    return np.where(distance > known[-1], beyond, np.interp(distance, known, times))
+
+
+# tables is a dictionary of the table of each mode; a move is slow unless the fast mode is known to manage it. only a
+# mode that has a table is returned, so a move beyond the fast table when the slow mode was not calibrated gives None,
+# and is timed as if the stage had not been calibrated
+def choose(tables, distance):
+    distance = abs(distance)
+    fast = tables.get('STA')
+    slow = tables.get('STS')
+    if fast is None or distance > fast['distance'][-1]:
+        return None if slow is None else 'STS'
+    if slow is None or movetime(fast, distance) <= movetime(slow, distance):
+        return 'STA'
+    return 'STS'
+
+
+def key(tables):
+    return json.dumps(tables, sort_keys=True) if tables else None
+
+
+# calibration ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def run(scope, name, distances=DISTANCES, repeats=3):
+    if scope.volume.isAlive():
+        print('warning: halt volume acquisition before calibrating the stage')
+        return None
+    print('stage motion sweep running')
+    found = sweep(scope, distances, MODES, repeats)
+    tables = {}
+    for mode in MODES:
+        table = fit(*found[mode])
+        if table is not None:
+            tables[mode] = table
+    if not tables:
+        print('error: no move settled, nothing saved')
+        return None
+    scope.mtm = tables
+    profiles.save(name, 'motion', {'mtm': tables, 'sweep': found, 'repeats': repeats})
+
+    for mode in MODES:
+        if mode in tables:
+            print(mode + ': ' + ', '.join('{0}mm {1:.3f}s'.format(distance, took) for distance, took in
+                                          zip(tables[mode]['distance'], tables[mode]['time'])))
+    print('stage motion saved to profile ' + name)
+    return tables
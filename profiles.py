@@ -0,0 +1,76 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library stores named profiles, the settings found by calibrating the rig, such as the
+# temperature controller gains for one sample holder, so that they can be reused rather than found again. a profile is
+# a json file in the profiles folder, holding a section for each kind of calibration.
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# json is used to store the profiles
+# os is used to find the profile files
+# time is used to stamp when a section was saved
+
+import json
+import os
+import time
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# FOLDER - the folder that holds the profiles
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# path - the file that holds a profile
+#
+# names - the names of the saved profiles
+#
+# load - reads a profile, or one section of it; an empty dictionary if there is none
+#
+# save - writes one section of a profile, leaving its other sections as they were
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+FOLDER = 'profiles'
+
+
+def path(name):
+    return os.path.join(FOLDER, name + '.json')
+
+
+def names():
+    if not os.path.isdir(FOLDER):
+        return []
+    return sorted(entry[:-5] for entry in os.listdir(FOLDER) if entry.endswith('.json'))
+
+
+def load(name, section=None):
+    try:
+        with open(path(name)) as profile:
+            sections = json.load(profile)
+    except IOError:
+        sections = {}
+    except ValueError:
+        print('warning: profile ' + name + ' could not be read')
+        sections = {}
+    if section is None:
+        return sections
+    return sections.get(section, {})
+
+
+# the profile is written to a temporary file first, so a failed write leaves the old one as it was. the old one is
+# removed before the rename, as windows will not rename over an existing file
+def save(name, section, values):
+    sections = load(name)
+    values = dict(values)
+    values['saved'] = time.strftime('%Y%m%d-%H%M%S')
+    sections[section] = values
+    if not os.path.isdir(FOLDER):
+        os.makedirs(FOLDER)
+    temp = path(name) + '.tmp'
+    with open(temp, 'w') as profile:
+        json.dump(sections, profile, indent=2, sort_keys=True)
+    if os.path.exists(path(name)):
+        os.remove(path(name))
+    os.rename(temp, path(name))
+    return values
@@ -0,0 +1,502 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library owns a serial port from a single thread. commands are taken from a queue and
+# written in order, and each response line is handed back to the request that is waiting for it, so that several
+# threads can share the arduino without a lock and without throwing away each other's responses. commands are written
+# in order of priority, acquisition triggers first and telemetry polls last, so that a poll cannot hold up a frame.
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# codecs is used to decode lines straight from the read buffer
+# threading is used to run the reactor and to signal completed requests
+# collections holds the queue of each priority
+# binproto decodes the binary frames that can arrive between the lines
+# telemetry decodes the heater and magnet lines into records
+# timing is the clock requests are stamped on, and keeps the queueing statistics of each priority
+
+import codecs
+import collections
+import threading
+
+import binproto
+import telemetry
+import timing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# Future - a command that has been queued, which completes when it has been written and its response has arrived
+#
+# SerialReactor - the thread that owns the port
+#
+# LineReader - drains the port in chunks into a reusable buffer and splits out the complete lines and frames
+#
+# Batch - gathers the commands of one operation so that they are written to the port in one go
+#
+# CommandQueue - the queue of commands waiting to be written, served in order of priority
+#
+# priorities ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# TRIGGER - acquisition triggers: FRM, RUN, RUNM, TRS and KLS
+#
+# MOTION - stage and mirror moves: DAC, STA, STS and STP
+#
+# CONTROL - configuration and control writes: SET, CFG, STH, STM and LON
+#
+# TELEMETRY - polls and reads: RDH, QRP, RDM, REP and ERR, and anything not listed
+#
+# AGE - how long in seconds a command of each priority may wait before it is written ahead of higher priorities, which
+# bounds how long a busy link can starve the lower ones
+#
+# kinds of response ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# None - no response is expected, the request completes once it is written
+#
+# line - any line that is not a heater line or an acknowledgement, as returned by ERR and REP
+#
+# float - a number, as returned by QRP
+#
+# heater - a heater line, $HC,MODE,1,PWM,400,TEMP,26.5,END, as returned by RDH; the result is a telemetry.HeaterSample
+#
+# magnet - a magnet line ending in END, as returned by RDM; the result is a telemetry.MagnetSample
+#
+# volume - a volume acknowledgement, $VL,<count>,END, as returned by RUN and RUNM
+#
+# config - a configuration acknowledgement, $CF,<number of parameters set>,END, as returned by CFG
+#
+# frame - a binary response frame with the opcode given by 'reply', see binproto; the result is its tuple of values
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+# match response lines ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def unsolicited(line):
+    return line.startswith('$HC') or line.startswith('$VL') or line.startswith('$CF')
+
+
+def isfloat(line):
+    try:
+        float(line)
+        return True
+    except ValueError:
+        return False
+
+
+MATCH = {
+    'line': lambda line: not unsolicited(line),
+    'float': isfloat,
+    'heater': lambda line: line.startswith('$HC') and line.endswith('END'),
+    'magnet': lambda line: line.endswith('END') and not unsolicited(line),
+    'volume': lambda line: line.startswith('$VL'),
+    'config': lambda line: line.startswith('$CF'),
+}
+
+PARSE = {
+    'float': float,
+    'heater': telemetry.heater,
+    'magnet': telemetry.magnet,
+}
+
+
+# priorities ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+TRIGGER = 0
+
+MOTION = 1
+
+CONTROL = 2
+
+TELEMETRY = 3
+
+NAMES = ('trigger', 'motion', 'control', 'telemetry')
+
+PRIORITY = {
+    b'FRM': TRIGGER, b'RUN': TRIGGER, b'RUNM': TRIGGER, b'TRS': TRIGGER, b'KLS': TRIGGER,
+    b'DAC': MOTION, b'STA': MOTION, b'STS': MOTION, b'STP': MOTION,
+    b'SET': CONTROL, b'CFG': CONTROL, b'STH': CONTROL, b'STM': CONTROL, b'LON': CONTROL,
+    binproto.DAC: MOTION, binproto.STA: MOTION, binproto.SET: CONTROL,
+}
+
+AGE = (0.0, 0.05, 0.2, 0.5)
+
+
+# a batch of several commands takes the highest priority among them
+def priority(data):
+    if data[:1] == bytearray([binproto.SYNC]):
+        frames = binproto.decode(data)[0]
+        return min([PRIORITY.get(op, TELEMETRY) for op, values in frames] or [TELEMETRY])
+    words = [cmd.split()[0] for cmd in data.split(b'\r') if cmd.strip()]
+    return min([PRIORITY.get(word, TELEMETRY) for word in words] or [TELEMETRY])
+
+
+# requests ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# lines is the number of response lines to collect, the result is the parsed line, or a list if more than one is
+# expected. timeout is counted from when the command is written, after which the result is None. queued, sent and
+# received are times on timing.clock
+
+class Future:
+
+    def __init__(self, data, kind=None, lines=1, timeout=5.0, reply=None, priority=None):
+        self.data = data
+        self.priority = priority
+        self.kind = kind
+        self.reply = reply
+        self.count = lines
+        self.timeout = timeout
+        self.lines = []
+        self.value = None
+        self.queued = None
+        self.sent = None
+        self.received = None
+        self.timedout = False
+        self.event = threading.Event()
+
+    def accepts(self, line):
+        return self.kind != 'frame' and MATCH[self.kind](line)
+
+    def acceptsframe(self, op):
+        return self.kind == 'frame' and self.reply == op
+
+    def feed(self, line):
+        self.lines.append(PARSE.get(self.kind, str)(line))
+        if len(self.lines) >= self.count:
+            self.finish(self.lines[0] if self.count == 1 else self.lines)
+            return True
+        return False
+
+    def finish(self, value):
+        self.value = value
+        self.received = timing.clock()
+        self.event.set()
+
+    def expire(self):
+        self.timedout = True
+        self.finish(None)
+
+    def done(self):
+        return self.event.isSet()
+
+    # wait for the response, returns None if it does not arrive
+    def result(self, timeout=None):
+        self.event.wait(timeout)
+        return self.value
+
+
+# reactor ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# poll is how long the reactor waits for a response line before it checks the queue for new commands again. lines that
+# no request is waiting for are counted in 'dropped' and printed when dbg is set, and frames with a bad checksum are
+# counted in 'corrupt'
+
+class SerialReactor:
+
+    def __init__(self, port, poll=0.002, dbg=False):
+        self.port = port
+        self.poll = poll
+        self.dbg = dbg
+        self.commands = CommandQueue()
+        self.pending = []
+        self.reader = LineReader(port)
+        self.dropped = 0
+        self.corrupt = 0
+        self.written = 0
+        self.writes = 0
+        self.local = threading.local()
+        self.halt = threading.Event()
+        self.thread = threading.Thread()
+
+    def start(self):
+        if self.thread.is_alive():
+            print('warning: thread already running')
+            return
+        self.halt.clear()
+        self.port.timeout = self.poll
+        self.thread = threading.Thread(name='serialio', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.halt.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    # queue a command, returns the future that completes with its response. the command is either an ascii string or
+    # an encoded binary frame. inside a batch, commands without a response are held back and share the batch's future,
+    # and a command with a response writes out the batch first. the priority is found from the command unless given
+    def submit(self, cmd, kind=None, lines=1, timeout=5.0, reply=None, priority=None):
+        data = cmd if isinstance(cmd, bytes) else cmd.encode('ascii')
+        if getattr(self.local, 'depth', 0):
+            if kind is None:
+                self.local.cmds.append(data)
+                return self.local.future
+            self.flushbatch()
+        request = Future(data, kind, lines, timeout, reply, priority)
+        self.commands.put(request)
+        return request
+
+    # gather the commands sent from this thread, e.g.
+    #   with reactor.batch():
+    #       reactor.submit('DAC 2048\r')
+    #       reactor.submit('STA 6.1\r')
+    def batch(self):
+        return Batch(self)
+
+    def flushbatch(self):
+        request = self.local.future
+        if self.local.cmds:
+            request.data = b''.join(self.local.cmds)
+            self.commands.put(request)
+        else:
+            request.finish(None)
+        self.local.cmds = []
+        self.local.future = Future(b'')
+
+    def run(self):
+        while not self.halt.isSet():
+            self.write(block=not self.pending)
+            if self.pending or self.port.in_waiting:
+                self.read()
+            self.expire()
+        # on stop, requests still waiting to be written are expired too, so nothing waits on them forever
+        for request in self.pending:
+            request.expire()
+        self.pending = []
+        while True:
+            try:
+                self.commands.get_nowait().expire()
+            except queue.Empty:
+                break
+
+    def write(self, block):
+        try:
+            request = self.commands.get(timeout=self.poll) if block else self.commands.get_nowait()
+        except queue.Empty:
+            return
+        while request is not None:
+            self.port.write(request.data)
+            self.written += len(request.data)
+            self.writes += 1
+            request.sent = timing.clock()
+            if request.kind is None:
+                request.finish(None)
+            else:
+                self.pending.append(request)
+            try:
+                request = self.commands.get_nowait()
+            except queue.Empty:
+                request = None
+
+    def read(self):
+        if not self.reader.fill():
+            return
+        for item in self.reader.take():
+            if isinstance(item, tuple):
+                self.dispatchframe(*item)
+            else:
+                self.dispatch(item)
+        self.corrupt = self.reader.corrupt
+
+    def dispatch(self, line):
+        for request in self.pending:
+            if request.accepts(line):
+                try:
+                    if request.feed(line):
+                        self.pending.remove(request)
+                    return
+                except (ValueError, IndexError):
+                    break
+        self.dropped += 1
+        if self.dbg:
+            print('unexpected response: ' + line)
+
+    def dispatchframe(self, op, values):
+        for request in self.pending:
+            if request.acceptsframe(op):
+                self.pending.remove(request)
+                request.finish(values)
+                return
+        self.dropped += 1
+        if self.dbg:
+            print('unexpected frame: ' + str(op))
+
+    def expire(self):
+        now = timing.clock()
+        for request in list(self.pending):
+            if now - request.sent > request.timeout:
+                self.pending.remove(request)
+                request.expire()
+
+    def report(self):
+        return self.commands.report()
+
+
+# command queue ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# there is a queue for each priority. triggers are always written first; after them, a command that has waited longer
+# than the AGE of its priority goes next, the oldest first, and otherwise the queue of the highest priority is served.
+# the commands of one thread are written in the order they were sent, so a command raises any of its thread's commands
+# still waiting at lower priorities to its own; a SET is never overtaken by the RUN sent after it. the time each
+# command waited is kept for its priority, along with how many were written ahead of higher priorities by age
+
+class CommandQueue:
+
+    def __init__(self, age=AGE):
+        self.age = age
+        self.lanes = [collections.deque() for name in NAMES]
+        self.ready = threading.Condition()
+        self.count = 0
+        self.waits = [timing.Stat() for name in NAMES]
+        self.aged = [0 for name in NAMES]
+
+    def put(self, request):
+        if request.priority is None:
+            request.priority = priority(request.data)
+        request.owner = threading.current_thread()
+        with self.ready:
+            request.queued = timing.clock()
+            request.order = self.count
+            self.count += 1
+            earlier = []
+            for lane in self.lanes[request.priority + 1:]:
+                for waiting in [waiting for waiting in lane if waiting.owner is request.owner]:
+                    lane.remove(waiting)
+                    earlier.append(waiting)
+            earlier.sort(key=lambda waiting: waiting.order)
+            self.lanes[request.priority].extend(earlier)
+            self.lanes[request.priority].append(request)
+            self.ready.notify()
+
+    # raises queue.Empty if nothing arrives within the timeout
+    def get(self, timeout=None):
+        with self.ready:
+            if not any(self.lanes):
+                self.ready.wait(timeout)
+            return self.take()
+
+    def get_nowait(self):
+        with self.ready:
+            return self.take()
+
+    def take(self):
+        # called with the lock held
+        waiting = [index for index, lane in enumerate(self.lanes) if lane]
+        if not waiting:
+            raise queue.Empty
+        now = timing.clock()
+        chosen = waiting[0]
+        if chosen != TRIGGER:
+            overdue = [index for index in waiting if now - self.lanes[index][0].queued > self.age[index]]
+            if overdue:
+                chosen = min(overdue, key=lambda index: self.lanes[index][0].order)
+                if chosen != waiting[0]:
+                    self.aged[chosen] += 1
+        request = self.lanes[chosen].popleft()
+        self.waits[request.priority].add(now - request.queued)
+        return request
+
+    def report(self):
+        with self.ready:
+            return '\n'.join(name + ': ' + str(self.waits[index].count) + ' commands, ' + str(self.aged[index])
+                             + ' written early by age, wait ' + self.waits[index].summary()
+                             for index, name in enumerate(NAMES))
+
+
+# batches ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# batches can be nested, the commands are written when the outermost one ends
+
+class Batch:
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def __enter__(self):
+        local = self.reactor.local
+        local.depth = getattr(local, 'depth', 0) + 1
+        if local.depth == 1:
+            local.cmds = []
+            local.future = Future(b'')
+        return local.future
+
+    def __exit__(self, kind, value, traceback):
+        local = self.reactor.local
+        local.depth -= 1
+        if local.depth == 0:
+            self.reactor.flushbatch()
+        return False
+
+
+# reader ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# everything waiting on the port is read into the buffer in one call, and only waits for the port timeout when nothing
+# has arrived. the unread part of the buffer runs from start to end; it is moved to the front when the buffer fills,
+# and the buffer grows only if a single line or frame does not fit. a line never holds a sync byte, so after a corrupt
+# frame the reader skips to the next sync byte or newline, whichever comes first, and bytes before a sync byte that
+# are not a complete line are skipped as corrupt
+
+class LineReader:
+
+    def __init__(self, port, size=4096):
+        self.port = port
+        self.buf = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.corrupt = 0
+
+    def fill(self):
+        size = max(self.port.in_waiting, 1)
+        if self.end + size > len(self.buf):
+            self.compact(size)
+        count = self.port.readinto(memoryview(self.buf)[self.end:self.end + size])
+        self.end += count or 0
+        return count
+
+    def compact(self, size):
+        unread = self.end - self.start
+        self.buf[:unread] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = unread
+        if unread + size > len(self.buf):
+            self.buf.extend(bytearray(unread + size - len(self.buf)))
+
+    # returns the complete lines, as stripped strings, and frames, as (opcode, values) tuples, in order of arrival
+    def take(self):
+        items = []
+        view = memoryview(self.buf)
+        while self.start < self.end:
+            if self.buf[self.start] == binproto.SYNC:
+                frame, nxt = binproto.decodeone(self.buf, self.start, self.end)
+                if nxt == self.start:
+                    break
+                if frame is None:
+                    self.corrupt += 1
+                    nxt = self.resync(nxt)
+                else:
+                    items.append(frame)
+                self.start = nxt
+                continue
+            stop = self.buf.find(b'\n', self.start, self.end)
+            sync = self.buf.find(bytearray([binproto.SYNC]), self.start, self.end if stop < 0 else stop)
+            if sync >= 0:
+                self.corrupt += 1
+                self.start = sync
+                continue
+            if stop < 0:
+                break
+            line = codecs.ascii_decode(view[self.start:stop], 'replace')[0].strip()
+            self.start = stop + 1
+            if line:
+                items.append(line)
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return items
+
+    # the next sync byte or newline from start, or the end if there is neither; a newline is left to end an empty line
+    def resync(self, start):
+        sync = self.buf.find(bytearray([binproto.SYNC]), start, self.end)
+        stop = self.buf.find(b'\n', start, self.end)
+        found = [index for index in (sync, stop) if index >= 0]
+        return min(found) if found else self.end
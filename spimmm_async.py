@@ -0,0 +1,342 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this class controls the SPIMMM from an asyncio event loop. the commands are coroutines, so
+# that polling, control, logging and acquisition can all run as tasks in one thread, and waiting on the arduino and
+# both lasers at once is a single gather. note that this library requires python 3.5 or later.
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# asyncio runs the event loop
+# serialio holds the rules for matching response lines, which are shared with the threaded reactor
+# spimmm_obj holds the parameters and calculations that are shared with the threaded class
+# telemetry holds the history of the polled values
+
+import asyncio
+import time
+
+import serialio
+import spimmm_obj
+import telemetry
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# AsyncLink - an async serial transport for the arduino; writes commands and resolves a future for each expected
+# response
+#
+# AsyncSPIMMM - the SPIMMM class with its hardware commands as coroutines
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# connect - open the ports and set up the arduino, stage and lasers
+#
+# close - close the ports
+#
+# looptemppoll - poll the heater board every plp seconds until temppoll_halt is set
+#
+# looptempcont - run the temperature controller on each fresh heater response until tempcont_halt is set
+#
+# looptemplog - log the heater responses every lgp seconds until templog_halt is set
+#
+# loopvol - take volumes one after another until volume_halt is set
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+# async serial transport ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the port is read when the event loop reports it readable. where the loop cannot watch the port (COM ports on
+# windows) it is read from the default executor instead
+
+class AsyncLink:
+
+    def __init__(self, port):
+        self.port = port
+        self.pending = []
+        self.buf = bytearray()
+        self.dropped = 0
+        self.loop = None
+        self.reader = None
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.port.timeout = 0
+        try:
+            self.loop.add_reader(self.port.fileno(), self.readable)
+        except (AttributeError, NotImplementedError, ValueError):
+            self.reader = self.loop.create_task(self.actread())
+
+    def stop(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        else:
+            try:
+                self.loop.remove_reader(self.port.fileno())
+            except (AttributeError, NotImplementedError, ValueError):
+                pass
+        for future, kind, count, lines in self.pending:
+            if not future.done():
+                future.set_result(None)
+        self.pending = []
+
+    async def actread(self):
+        self.port.timeout = 0.05
+        while True:
+            data = await self.loop.run_in_executor(None, self.port.read, 4096)
+            if data:
+                self.received(data)
+
+    def readable(self):
+        self.received(self.port.read(max(self.port.in_waiting, 1)))
+
+    def received(self, data):
+        self.buf += data
+        while True:
+            end = self.buf.find(b'\n')
+            if end < 0:
+                return
+            line = self.buf[:end].decode('ascii', 'replace').strip()
+            del self.buf[:end + 1]
+            if line:
+                self.dispatch(line)
+
+    def dispatch(self, line):
+        for entry in self.pending:
+            future, kind, count, lines = entry
+            if serialio.MATCH[kind](line):
+                try:
+                    lines.append(serialio.PARSE.get(kind, str)(line))
+                except (ValueError, IndexError):
+                    break
+                if len(lines) >= count:
+                    self.pending.remove(entry)
+                    if not future.done():
+                        future.set_result(lines[0] if count == 1 else lines)
+                return
+        self.dropped += 1
+
+    # write a command, returning a future for its response if one is expected
+    def submit(self, cmd, kind=None, lines=1):
+        self.port.write(cmd.encode('ascii'))
+        if kind is None:
+            return None
+        future = self.loop.create_future()
+        self.pending.append((future, kind, lines, []))
+        return future
+
+    async def query(self, cmd, kind='line', lines=1, timeout=5.0):
+        future = self.submit(cmd, kind, lines)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self.pending = [entry for entry in self.pending if entry[0] is not future]
+            return None
+
+
+# asynchronous SPIMMM ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the parameters, calibration and controller calculations are those of SPIMMM. the object is made without touching
+# the hardware; await connect() from the event loop before using it, e.g.
+#   scope = AsyncSPIMMM(**ports)
+#   await scope.connect()
+#   pos, tcr = await asyncio.gather(scope.get_pos(), scope.rdh())
+
+class AsyncSPIMMM(spimmm_obj.SPIMMM):
+
+    def __init__(self, ard_port=None, las1_port=None, las2_port=None):
+        if ard_port is not None:
+            self.ard = spimmm_obj.makeport(ard_port, 115200)
+        if las1_port is not None:
+            self.las1 = spimmm_obj.makeport(las1_port, 9600)
+        if las2_port is not None:
+            self.las2 = spimmm_obj.makeport(las2_port, 9600)
+        self.link = AsyncLink(self.ard)
+        self.fresh = None
+        self.hist = telemetry.History(self.hln)
+
+    async def connect(self):
+        loop = asyncio.get_event_loop()
+        # open the ports in the executor, as the arduino blocks until it sends its startup string
+        await loop.run_in_executor(None, self.open_ports)
+        self.link.start()
+        self.fresh = asyncio.Event()
+        await self.sendcfg()
+        await self.get_pos()
+        await self.laser_power()
+
+    def open_ports(self):
+        if not self.ard.isOpen():
+            try:
+                self.ard.open()
+                # clear the startup string received from the arduino before the event loop takes over the port
+                self.ard.readline()
+                print('arduino connected')
+            except spimmm_obj.serial.SerialException:
+                raise UserWarning('could not connect to arduino')
+
+        for laser, name in ((self.las1, '488nm'), (self.las2, '561nm')):
+            if not laser.isOpen():
+                try:
+                    laser.open()
+                    print(name + ' laser connected')
+                except spimmm_obj.serial.SerialException:
+                    print('could not connect to ' + name + ' laser')
+
+    async def close(self):
+        self.link.stop()
+        self.close_ports()
+
+    # queue arduino commands ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    async def send(self, cmd):
+        self.link.submit(cmd + '\r')
+
+    async def query(self, cmd, kind='line', lines=1, timeout=5.0):
+        return await self.link.query(cmd + '\r', kind, lines, timeout)
+
+    async def sendcfg(self):
+        await self.send(self.cfgcmd())
+
+    async def readcfg(self):
+        resp = await self.query('REP', lines=20)
+        if resp is None:
+            print('error: no response from arduino')
+            return
+        for line in resp:
+            print(line)
+
+    # set both lasers at once ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # the lasers do not respond, so each one's commands are written in one go from the executor, side by side
+
+    async def laser_power(self):
+        writes = []
+        for laser, power, state, name in ((self.las1, self.pwr1, self.lst1, '488nm'),
+                                          (self.las2, self.pwr2, self.lst2, '561nm')):
+            if not laser.isOpen():
+                print('error: ' + name + ' laser not connected')
+                continue
+            cmds = self.lasercmds(power, state, name)
+            writes.append(asyncio.get_event_loop().run_in_executor(
+                None, laser.write, ''.join(cmd + '\r' for cmd in cmds).encode('ascii')))
+        if writes:
+            await asyncio.gather(*writes)
+
+    # stage and mirror ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    async def mirror(self, count):
+        try:
+            await self.send('DAC ' + str(int(count)))
+        except ValueError:
+            print('error: mirror value not an int')
+
+    async def stage(self, position):
+        cmd = self.stagecmd(position)
+        if cmd is not None:
+            await self.send(cmd)
+
+    async def focus(self, location):
+        # the command order here is important! See Stage
+        # both commands are written together, so that the stage and mirror move as close together as possible
+        cmds = ['DAC ' + str(int(self.stm(location)))]
+        cmd = self.stagecmd(location)
+        if cmd is not None:
+            cmds.append(cmd)
+        await self.send('\r'.join(cmds))
+
+    async def get_pos(self):
+        resp = await self.query('QRP', 'float')
+        if resp is None:
+            print('stage poll error')
+        else:
+            self.pos = resp
+            self.hist.add(time.time(), pos=resp)
+        return self.pos
+
+    async def err(self):
+        resp = await self.query('ERR', lines=2)
+        if resp is None:
+            print('error: no response from stage')
+            return
+        resp = '\n'.join(resp)
+        print(resp)
+        return resp
+
+    async def frame(self, cam, length):
+        try:
+            await self.send('FRM ' + str(int(cam)) + ' ' + str(int(length)))
+        except ValueError:
+            print('frame length set incorrectly')
+
+    # volumes ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    async def tkv(self, timeout=600.0):
+        return await self.query('RUN', 'volume', timeout=timeout)
+
+    async def loopvol(self):
+        await self.sendcfg()
+        print('microscope running')
+        self.volume_halt.clear()
+        while not self.volume_halt.isSet():
+            await self.tkv()
+
+    # temperature ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    async def sdh(self):
+        await self.send('STH')
+
+    async def rdh(self):
+        resp = await self.query('RDH', 'heater')
+        while resp is None:
+            print('temperature poll error')
+            await asyncio.sleep(0.1)
+            resp = await self.query('RDH', 'heater')
+        return resp
+
+    async def readmag(self):
+        resp = await self.query('RDM', 'magnet')
+        if resp is None:
+            print('magnet poll error')
+        else:
+            self.hist.add(resp.time, cur1=resp.cur1, cur2=resp.cur2, cur3=resp.cur3, cur4=resp.cur4)
+        return resp
+
+    async def clt(self):
+        self.tcalc()
+        await self.send(self.cfgcmd() + '\rSTH')
+
+    async def looptemppoll(self):
+        self.temppoll_halt.clear()
+        while not self.temppoll_halt.isSet():
+            self.tcr = await self.rdh()
+            self.hist.add(self.tcr.time, temp=self.tcr.temp, pwm=self.tcr.pwm, mode=self.tcr.mode)
+            self.data_in.set()
+            self.fresh.set()
+            await asyncio.sleep(self.plp)
+        self.data_in.clear()
+
+    async def looptempcont(self):
+        print('temperature controller running')
+        self.ers = 0
+        self.tempcont_halt.clear()
+        while not self.tempcont_halt.isSet():
+            # act on each fresh heater response, at most once every ttc seconds
+            await self.fresh.wait()
+            self.fresh.clear()
+            await self.clt()
+            await asyncio.sleep(self.ttc)
+        self.htm = 0
+        self.fnm = 0
+        await self.send(self.cfgcmd() + '\rSTH')
+
+    async def looptemplog(self):
+        await self.fresh.wait()
+        print('temperature logging running')
+        timestr = time.strftime('%Y%m%d-%H%M%S')
+        contstring = 'Kp' + '_' + str(self.tkp) + '_' + 'Ki' + '_' + str(self.tki)
+        templogname = 'templog/templog_' + timestr + '_' + contstring + '.csv'
+        with open(templogname, 'a') as templogfile:
+            templogfile.write('Device,,Mode,,PWM,,Temp,,\n')
+            self.templog_halt.clear()
+            while not self.templog_halt.isSet():
+                templogfile.write(str(self.tcr) + ',' + 'SET TEMP' + ',' + str(self.tem) + ',' + 'SYS TIME' + ','
+                                  + str(time.time()) + '\n')
+                await asyncio.sleep(self.lgp)
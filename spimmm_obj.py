@@ -3,9 +3,29 @@
 
 # libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # serial is used for communication with the hardware
+# serialio runs the thread that owns the arduino port
+# binproto encodes and decodes the binary frames used when bin is set
+# telemetry holds the heater and magnet records and their history
+# timing keeps the latency and jitter statistics of the temperature controller and z scans, and waits for deadlines
+# binlog writes the temperature logs as binary columns
+# autotune tunes the temperature controller and profiles stores the settings found
+# zscan plans the stage and mirror positions and frame times of a volume
+# motion calibrates the time the stage takes to move
+# calib fits the mirror calibration to the points recorded
+# channels works out the order and laser switches of a multi-channel acquisition
 
 import serial
-import re
+import serialio
+import binproto
+import telemetry
+import timing
+import binlog
+import autotune
+import profiles
+import zscan
+import motion
+import calib
+import channels
 import time
 import threading
 
@@ -18,11 +38,29 @@ import threading
 # smt - small move time in milliseconds; the time taken to make a small move on the stage,
 # which is measured manually from the PI step response tool
 #
+# mtm - the motion tables of the stage from calibratemotion, the time a move of each distance takes in each of STA and
+# STS; None to wait smt for each small move and to move slowly from 10um, as before
+#
 # frt - time between frames in milliseconds
 #
+# cmp - what the camera loop does when it misses a frame period: 'skip' drops the missed frames, 'catchup' triggers them
+# at once; see timing.Periodic
+#
+# cms - the timing of the camera loop, a timing.Periodic with the achieved frame rate and the trigger jitter
+#
+# chn - the channels of a multi-channel acquisition: rows of (name, camera, 488nm laser state, 561nm laser state)
+#
+# chm - interleave the channels by 'frame', triggering each frame on the next channel every frt milliseconds, or by
+# 'volume', taking a z scan on each channel in turn
+#
+# che - the number of frames or volumes taken on a channel before moving to the next
+#
+# chs - the frames taken on each channel of the last multi-channel acquisition and the rate achieved, a
+# channels.ChannelStats
+#
 # exp - camera exposure time in milliseconds
 #
-# tcr - temperature control board response
+# tcr - temperature control board response, the last telemetry.HeaterSample read
 #
 # htm - heater mode; 0 off, 1 cool, 2 heat
 #
@@ -36,6 +74,12 @@ import threading
 #
 # ttc - the period of the control loop in seconds
 #
+# tev - run the control loop on each fresh heater sample from the poll, rather than every ttc seconds
+#
+# tdc - the decimation ratio of the event driven control loop; it acts on every tdc-th fresh sample
+#
+# tls - the latency and jitter statistics of the control loop, reset each time it starts
+#
 # tkp - proportional control constant for the temperature control module (heating mode)
 #
 # tkpc - proportional control constant for the temperature control module (cooling mode)
@@ -44,17 +88,65 @@ import threading
 #
 # ers - total error for the heater controller
 #
+# tat - the time of the heater sample the controller last acted on, from which the time the integral is taken over is
+# measured; None until it has acted
+#
+# tcm - the control mode: 'pi' for the clamped PI controller, 'ffgs' for feedforward with gains scheduled by tgt
+#
+# amb - the ambient temperature in degrees C, which the feedforward of 'ffgs' works from
+#
+# tgh - the heating gain of the bath in degrees C per unit of pwm, the rise held in the steady state; set by autotune
+#
+# tgc - the cooling gain of the bath in degrees C per unit of pwm, with the fan on; set by autotune
+#
+# tgt - the gain table of 'ffgs': rows of (upper setpoint of the band in degrees C, tkp, tkpc, tki), in rising order,
+# such as ((25.0, 120, 600, 1.5), (35.0, 150, 450, 1.5)); setpoints above the last band use its gains. when None, the
+# gains tuned by autotune, tkp, tkpc and tki, are used at every setpoint
+#
+# tcf - the cooling factor; the proportion of maximum power that can be applied in cooling mode
+#
+# twl - the error in degrees C beyond which the integrator is reset, to prevent wind-up
+#
+# taw - the anti-windup scheme of the integrator: 'reset' resets it beyond twl degrees of error, 'hold' also stops it
+# summing while the heater output is saturated in the direction of the error
+#
 # ont - boolean value indicating if the temperature controller is on target
 #
 # tst - engage temperature step mode
 #
 # lgp - the logging period for temperature logging
 #
-# plp - the polling period for temperature polling
+# lgf - the format of the temperature log; 'bin' for a binlog column log (.splg), which binlog.read loads into numpy
+# arrays and binlog.tocsv exports, or 'csv' for the original text log
+#
+# plp - the polling period for temperature polling; the shortest period when apl is set
+#
+# apl - adapt the polling period: poll every plp seconds while the temperature is moving or off target, back off
+# towards plx while it is stable, and poll every plx seconds while a volume is running
+#
+# plx - the longest polling period for adaptive polling
+#
+# tps - the range in degrees C within which the temperature must stay over the last tpw seconds to count as stable
+#
+# tpw - the window in seconds over which stability is judged
+#
+# pls - the round trip and bus time statistics of the temperature poll, reset each time it starts
+#
+# spn - the time in seconds before each deadline of a z scan that is spent spinning rather than sleeping, see
+# timing.sleepuntil; raise it to 0.016 on windows
+#
+# scs - the timing of the last z scan: the latency is how late each frame was triggered, and the jitter that of the
+# period between frames
 #
 # slp - slope parameter of stage distance to mirror DAC count relation
 #
-# off - offset parameter of stage distance to mirror DAC count relation
+# posadj - the stage position in mm at which the mirror is at its largest count, 4095
+#
+# off - offset parameter of stage distance to mirror DAC count relation, worked out from posadj and slp
+#
+# mrc - the mirror count last sent
+#
+# cpt - the (stage position, mirror count) pairs recorded by calpoint for makecal
 #
 # dup - upper distance limit of stage in mm
 #
@@ -66,7 +158,22 @@ import threading
 #
 # imt - imaging time in seconds
 #
-# vrt - time between volumes in seconds
+# vrt - time between volumes in seconds; voltime starts a volume every vrt seconds
+#
+# vlp - what voltime does when a volume overruns its vrt: 'skip' drops the timepoints it ran into, 'delay' starts the
+# next volume at once and moves the later ones back, 'shorten' starts the next at once and cuts the top of the stack, by
+# lowering dup, until a volume fits in vrt; dup is put back at the end
+#
+# vlr - the record of the last time-lapse: a dictionary for each timepoint of its planned and actual start and its
+# duration in seconds from the start, the number of slices, whether the volume was acknowledged and the timepoints
+# skipped after it
+#
+# vls - the timing of the last time-lapse; the latency is how late each volume started
+#
+# vto - the seconds allowed beyond the expected time of a volume for its acknowledgement to arrive
+#
+# vst - the volume statistics since the microscope last started running volumes: those acknowledged, timed out and
+# missed, the backlog, the latency of each and the volumes per second, a timing.VolumeStats
 #
 # pwr1 - the 488nm laser power in Watts
 #
@@ -85,6 +192,19 @@ import threading
 # cur4 - the first coil's current value in mA
 #
 # led - the white led's intensity value 0-1023
+#
+# dlt - send only the changed configuration parameters to the arduino; cleared if the arduino does not acknowledge them
+#
+# devcfg - the configuration last acknowledged by the arduino, None until a full configuration has been sent
+#
+# bin - use the binary frames of binproto for SET, RDH, DAC, STA and QRP instead of the ascii commands
+#
+# hln - the number of values kept for each channel of the telemetry history
+#
+# hist - the telemetry history, a telemetry.History of the polled heater samples, the controller terms, the stage
+# positions read and the coil currents read; e.g. self.hist.last('temp', 60) gives the times and temperatures of the
+# last minute
+#
 # serial objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #
 # ard - arduino COM port; the COM port that the OS assigns to the arduino,
@@ -94,39 +214,68 @@ import threading
 #
 # las2 - 561nm laser COM port; the COM port that the OS assigns to the coherent laser
 #
+# io - the reactor that owns the arduino port; all arduino commands are queued on it and their responses returned.
+# commands are written in order of priority, triggers first and telemetry polls last, see serialio
+#
 # threading objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #
 # volume_halt - signals to the thread that runs the hardware when a volume is taken
 #
 # camera_halt - signals to the thread that runs the camera
 #
+# multi_halt - signals to the thread that runs the multi-channel acquisition
+#
 # tempcont - signals to the thread that runs the temperature controller
 #
 # templog - signals to the thread that runs the temperature logger
 #
 # temppoll - signals to the thread that runs the heater board poll
 #
+# fresh - notified by the heater board poll each time it stores a new sample in tcr; seq counts the samples
+#
 # volume_running - signals that a volume is running
 #
 # functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #
+# makeport - makes a serial object from a COM port name or a pyserial url, for running against the emulator
+#
 # open_ports - open the COM ports for communication with the hardware
 #
+# send - queue a command for the arduino that has no response
+#
+# query - queue a command for the arduino and wait for its response
+#
+# sendframe / queryframe - as send and query, for binary frames
+#
 # close_ports - close ports opened by 'open_ports'
 #
-# setcal - allows user input to set the mirror/stage calibration variables
+# setcal - sets the mirror/stage calibration variables and sends them to the arduino
+#
+# calpoint - records the stage position and the mirror count last sent, once the sample is in focus, for makecal
+#
+# makecal - fits slp and posadj to the points recorded by calpoint, and saves them as the profile of an objective and
+# sample holder; see calib
 #
-# sendcfg - sends configuration variables to the arduino for running a volume
+# sendcfg - sends configuration variables to the arduino for running a volume, only those that have changed unless
+# full is set
+#
+# cfgcmd - builds the SET command that sendcfg sends
 #
 # readcfg - reads configuration variables from the arduino
 #
 # laser_power - sets the laser power according to the level set in cfg.pwr1 and cfg.pwr2 and sets the lasers on or off
 #
+# lasercmds - builds the commands that laser_power sends to one laser
+#
+# sendlaser - writes a command string to a laser as ascii bytes
+#
 # mirror - takes a count between 0 and 1023 and converts it into a voltage that controls the laser position
 #
 # stage - takes a position between -6.5 and 6.5 and translates the stage to that position by communicating with the
 # arduino
 #
+# stagecmd - builds the command that stage sends, choosing between a slow and a fast move
+#
 # rbt - reboots the stage by communicating with the arduino
 #
 # engage - engages the stage by communicating with the arduino
@@ -141,23 +290,54 @@ import threading
 #
 # stm - takes the stage position and returns the required mirror position according to the calibration parameters
 #
-# pau - takes the stage distance to move and returns the time to wait for it to complete, based on the small move time
+# pau - takes the stage distance to move and returns the time to wait for it to complete, from the motion tables if the
+# stage has been calibrated and otherwise from the small move time
+#
+# calibratemotion - sweeps the stage through moves in both modes to measure mtm, and saves it as a named profile
 #
 # tkv - command the microscope to take a volume from the arduino
 #
+# tkvm - command the microscope to take num_frame volumes in a row
+#
+# waitvol - waits for the acknowledgements of tkv or tkvm and records them in vst
+#
+# scanplan - plans the volume from dlo to dup with zscan: the stage positions, mirror counts and frame times
+#
+# scan - takes the volume planned by scanplan, moving and triggering from here against deadlines rather than from the
+# arduino
+#
 # err - reset the error on the stage driver
 #
 # sdh - push the heater parameters to the heater
 #
-# rdh - read the heater parameters from the heater
+# rdh - read the heater parameters from the heater as a telemetry.HeaterSample
+#
+# readheater - read the heater parameters once, returning None if they do not arrive
 #
 # clt - control the temperature
 #
+# steady - whether every temperature polled over the last given number of seconds is within a band of the setpoint
+#
+# tcalc - calculate the heater parameters for clt from the last heater response
+#
+# ffgs - the feedforward and gain scheduled controller that tcalc uses when tcm is 'ffgs'
+#
+# controlstep - the seconds since the controller last acted, that the error is integrated over
+#
+# feedforward - the signal that holds a setpoint in the steady state
+#
+# schedule - looks up tkp, tkpc and tki for a setpoint in tgt, or gives the tuned ones if there is no table
+#
+# autotune - runs heating and cooling step tests to tune tkp, tkpc and tki, and saves them as a named profile
+#
+# useprofile - sets the parameters stored in a named profile and sends the configuration to the arduino; a profile
+# can also be given when the SPIMMM is made, so that it is in use from the start
+#
 # setmag - set the current value of all magnet channels, note that this also requires a hard or soft trigger
 #
 # setled - set the led intensity value
 #
-# readmag - read the magnet controller status
+# readmag - read the magnet controller status as a telemetry.MagnetSample
 #
 # trigmag - trigger the magnet controller on or off in software
 #
@@ -167,6 +347,14 @@ import threading
 #
 # haltcam - halts the thread that runs 'actcam'
 #
+# actmulti - not to be used directly, this function runs the channels of chn in turn, switching the lasers between them
+#
+# startmulti - starts a thread that runs 'actmulti', which will run until 'haltmulti' is called
+#
+# haltmulti - halts the thread that runs 'actmulti'
+#
+# writelasers - writes a command string to each laser, skipping empty ones
+#
 # actvol - not to be used directly, this function instructs the hardware to take a volume on repeat
 #
 # startvol - starts a thread that runs 'actvol' which will run until 'haltvol' is called
@@ -175,8 +363,16 @@ import threading
 #
 # voltime - starts a thread that runs 'actvol' which will run for a period of time defined in cfg.imt
 #
+# lapse - not to be used directly, the time-lapse that actvol runs for voltime
+#
+# shorten - not to be used directly, cuts the stack so that a volume fits in vrt
+#
 # acttempcont - not to be used directly, this function instructs the temperature control module to set the temperature
 #
+# tempevents - not to be used directly, the event driven control loop that acttempcont runs when tev is set
+#
+# pollperiod - not to be used directly, works out the next period of the adaptive temperature poll
+#
 # tempcont - starts a thread that runs simple temperature control from acttempcont
 #
 # actemplog - not to be used directly, this function reads the temperature control module and logs the parameters
@@ -185,15 +381,52 @@ import threading
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+# the parameters that useprofile takes from each section of a profile
+PROFILEFIELDS = {
+    'thermal': ('tkp', 'tkpc', 'tki', 'tgh', 'tgc', 'amb', 'tgt'),
+    'motion': ('mtm',),
+    'focus': ('slp', 'posadj'),
+}
+
+# the configuration parameters in the order of the SET command; CFG takes any of them as name value pairs
+CFGFIELDS = ('smt', 'frt', 'exp', 'htm', 'hpw', 'fnm', 'cur1', 'cur2', 'cur3', 'cur4', 'led', 'slp', 'off', 'dup',
+             'dlo', 'ste', 'camera2', 'num_frame', 'frame_period')
+
+
+def makeport(port, baudrate):
+    # ports can be given as a COM port name, a device path or any pyserial url, such as the 'socket://' urls served by
+    # the emulator
+    return serial.serial_for_url(port, baudrate=baudrate, timeout=5, do_not_open=True)
+
+
 class SPIMMM:
 
-    def __init__(self):
+    def __init__(self, ard_port=None, las1_port=None, las2_port=None, io=None, profile=None):
         # perform all the necessary actions for setting up
         # connect the serial ports, set up the arduino, stage and laser
+        # the ports default to those of the rig, set below. if io is given, such as a thermsim.SimIO, it stands in for
+        # the arduino's reactor and no ports are opened. if profile is given, its settings are used from the start
+
+        if ard_port is not None:
+            self.ard = makeport(ard_port, 115200)
+        if las1_port is not None:
+            self.las1 = makeport(las1_port, 9600)
+        if las2_port is not None:
+            self.las2 = makeport(las2_port, 9600)
+
+        self.hist = telemetry.History(self.hln)
+        self.cpt = []
+
+        if profile is not None:
+            self.useprofile(profile)
+
+        if io is not None:
+            self.io = io
+            self.sendcfg()
+            self.get_pos()
+            return
 
         self.open_ports()
-        # clear the startup string received from the arduino
-        self.ard.readline()
         self.sendcfg()
         self.get_pos()
         self.laser_power()
@@ -203,11 +436,25 @@ class SPIMMM:
 
     smt = 20
 
+    mtm = None
+
     frt = 25
 
+    cmp = 'skip'
+
+    cms = timing.Periodic(0.025, name='camera')
+
+    chn = (('488nm', 0, True, False), ('561nm', 1, False, True))
+
+    chm = 'frame'
+
+    che = 1
+
+    chs = channels.ChannelStats(())
+
     exp = 10
 
-    tcr = ''
+    tcr = telemetry.HeaterSample(stamp=0.0)
 
     htm = 0
 
@@ -221,6 +468,12 @@ class SPIMMM:
 
     ttc = 1
 
+    tev = False
+
+    tdc = 1
+
+    tls = timing.LoopStats('temperature control')
+
     tkp = 120
 
     tkpc = 600
@@ -229,20 +482,58 @@ class SPIMMM:
 
     ers = 0
 
+    tat = None
+
+    tcm = 'pi'
+
+    amb = 21.0
+
+    tgh = 0.02
+
+    tgc = 0.012
+
+    tgt = None
+
+    tcf = 0.75
+
+    twl = 8
+
+    taw = 'reset'
+
     ont = False
 
     tst = False
 
     lgp = 1
 
+    lgf = 'bin'
+
     plp = 0.1
 
+    apl = False
+
+    plx = 2.0
+
+    tps = 0.1
+
+    tpw = 10
+
+    pls = timing.PollStats('temperature poll', 0.1)
+
+    spn = timing.SPIN
+
+    scs = timing.LoopStats('z scan')
+
     slp = -4486.982
 
     posadj = 6.1
 
     off = int(posadj * slp)
 
+    mrc = 0
+
+    cpt = []
+
     dup = 6.3
 
     dlo = 6.0
@@ -255,6 +546,16 @@ class SPIMMM:
 
     vrt = 0.5
 
+    vlp = 'skip'
+
+    vlr = []
+
+    vls = timing.LoopStats('time-lapse')
+
+    vto = 5.0
+
+    vst = timing.VolumeStats('volumes')
+
     pwr1 = 0.010
 
     pwr2 = 0.010
@@ -279,6 +580,14 @@ class SPIMMM:
 
     frame_period = 500  # ms
 
+    dlt = True
+
+    devcfg = None
+
+    bin = False
+
+    hln = 100000
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     # serial objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -302,6 +611,8 @@ class SPIMMM:
 
     camera_halt = threading.Event()
 
+    multi_halt = threading.Event()
+
     volume_halt = threading.Event()
 
     tempcont_halt = threading.Event()
@@ -314,10 +625,16 @@ class SPIMMM:
 
     data_in = threading.Event()
 
+    fresh = threading.Condition()
+
+    seq = 0
+
     volume_running = threading.Event()
 
     camera = threading.Thread()
 
+    multi = threading.Thread()
+
     volume = threading.Thread()
 
     tempcont = threading.Thread()
@@ -328,7 +645,7 @@ class SPIMMM:
 
     test = threading.Thread()
 
-    seriallock = threading.Lock()
+    io = None
 
     # functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -337,6 +654,11 @@ class SPIMMM:
             try:
                 # readline blocks further execution until the port is connected and the arduino responds
                 self.ard.open()
+                # clear the startup string received from the arduino before the reactor takes over the port
+                self.ard.readline()
+                self.devcfg = None
+                self.io = serialio.SerialReactor(self.ard)
+                self.io.start()
                 print('arduino connected')
             except serial.SerialException:
                 raise UserWarning('could not connect to arduino')
@@ -356,105 +678,109 @@ class SPIMMM:
                 print('could not connect to 561nm laser')
 
     def close_ports(self):
+        if self.io is not None:
+            self.io.stop()
+            if self.dbg:
+                print(self.io.report())
         self.ard.close()
         self.las1.close()
         self.las2.close()
 
+    # queue arduino commands ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # kind is the kind of response to wait for, as described in serialio, and lines the number of lines of it. query
+    # returns None if the response does not arrive within the timeout. commands sent inside 'with self.io.batch():'
+    # are written to the arduino in one go
+
+    def send(self, cmd):
+        return self.io.submit(cmd + '\r')
+
+    def query(self, cmd, kind='line', lines=1, timeout=5.0):
+        return self.io.submit(cmd + '\r', kind, lines, timeout).result(timeout + 1.0)
+
+    def sendframe(self, op, values=()):
+        return self.io.submit(binproto.encode(op, values))
+
+    def queryframe(self, op, values=(), timeout=5.0):
+        return self.io.submit(binproto.encode(op, values), 'frame', timeout=timeout,
+                              reply=op | binproto.REPLY).result(timeout + 1.0)
+
     # send and read configuration parameters ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def sendcfg(self):
-
-        self.seriallock.acquire()
-        self.ard.write(
-            'SET {0} {1} {2} {3} {4} {5} {6} {7} {8} {9} {10} {11} {12} {13} {14} {15} {16} {17} {18}\r'.format(
-                str(self.smt),
-                str(self.frt),
-                str(self.exp),
-                str(self.htm),
-                str(self.hpw),
-                str(self.fnm),
-                str(self.cur1),
-                str(self.cur2),
-                str(self.cur3),
-                str(self.cur4),
-                str(self.led),
-                str(self.slp),
-                str(self.off),
-                str(self.dup),
-                str(self.dlo),
-                str(self.ste),
-                str(self.camera2),
-                str(self.num_frame),
-                str(self.frame_period)))
-        self.seriallock.release()
+    def sendcfg(self, full=False):
+        values = self.cfgvalues()
+        if full or not self.dlt or self.devcfg is None:
+            if self.bin:
+                self.sendframe(binproto.SET, [getattr(self, field) for field in CFGFIELDS])
+            else:
+                self.send(self.cfgcmd(values))
+            self.devcfg = values
+            return
+
+        # send the changed parameters by name, and fall back to the full SET if the arduino does not acknowledge them
+        changed = [field for field in CFGFIELDS if values[field] != self.devcfg[field]]
+        if not changed:
+            return
+        resp = self.query('CFG ' + ' '.join(field + ' ' + values[field] for field in changed), 'config', timeout=0.5)
+        if resp is None or resp != '$CF,' + str(len(changed)) + ',END':
+            print('warning: partial configuration not acknowledged, sending full configuration')
+            self.dlt = False
+            self.sendcfg(full=True)
+            return
+        self.devcfg = values
+
+    def cfgvalues(self):
+        return dict((field, str(getattr(self, field))) for field in CFGFIELDS)
+
+    def cfgcmd(self, values=None):
+        if values is None:
+            values = self.cfgvalues()
+        return 'SET ' + ' '.join(values[field] for field in CFGFIELDS)
 
     def readcfg(self):
-        self.ard.flushInput()
-        self.seriallock.acquire()
-        self.ard.write('REP\r')
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        print(self.ard.readline())
-        self.seriallock.release()
+        resp = self.query('REP', lines=20)
+        if resp is None:
+            print('error: no response from arduino')
+            return
+        for line in resp:
+            print(line)
 
     # set laser power and update state ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def laser_power(self):
-        # the Coherent laser only takes arguments up to the nearest mW,
-        # this will also cause an error if anything but a number comes in
+        # each laser's commands are written in one go
         if self.las1.isOpen():
-            try:
-                if self.pwr1 > 0.0:
-                    power1 = round(self.pwr1, 3)
-                    print('488nm laser set to ' + str(power1 * 1000) + 'mW')
-                    self.las1.write('SOUR:AM:INT\r')
-                    self.las1.write('SOUR:POW:LEV:IMM:AMPL ' + str(power1) + ' \r')
-                else:
-                    print('488nm laser power must be positive')
-            except TypeError:
-                print('488nm laser power set incorrectly')
-            if self.lst1:
-                self.las1.write('SOUR:AM:STAT ON\r')
-            else:
-                self.las1.write('SOUR:AM:STAT OFF\r')
+            self.sendlaser(self.las1, ''.join(cmd + '\r' for cmd in self.lasercmds(self.pwr1, self.lst1, '488nm')))
         else:
             print('error: 488nm laser not connected')
 
         if self.las2.isOpen():
-            try:
-                if self.pwr2 > 0.0:
+            self.sendlaser(self.las2, ''.join(cmd + '\r' for cmd in self.lasercmds(self.pwr2, self.lst2, '561nm')))
+        else:
+            print('error: 561nm laser not connected')
 
-                    power2 = round(self.pwr2, 3)
-                    print('561nm laser set to ' + str(power2 * 1000) + 'mW')
-                    self.las2.write('SOUR:AM:INT\r')
-                    self.las2.write('SOUR:POW:LEV:IMM:AMPL ' + str(power2) + ' \r')
-                else:
-                    print('561nm laser power must be positive')
-            except TypeError:
-                print('561nm laser power set incorrectly')
-            if self.lst2:
-                self.las2.write('SOUR:AM:STAT ON\r')
+    # the port takes bytes, as the arduino's commands are encoded in serialio
+    def sendlaser(self, port, cmd):
+        port.write(cmd.encode('ascii'))
+
+    def lasercmds(self, power, state, name):
+        # the Coherent laser only takes arguments up to the nearest mW,
+        # this will also cause an error if anything but a number comes in
+        cmds = []
+        try:
+            if power > 0.0:
+                power = round(power, 3)
+                print(name + ' laser set to ' + str(power * 1000) + 'mW')
+                cmds.append('SOUR:AM:INT')
+                cmds.append('SOUR:POW:LEV:IMM:AMPL ' + str(power) + ' ')
             else:
-                self.las2.write('SOUR:AM:STAT OFF\r')
+                print(name + ' laser power must be positive')
+        except TypeError:
+            print(name + ' laser power set incorrectly')
+        if state:
+            cmds.append('SOUR:AM:STAT ON')
         else:
-            print('error: 561nm laser not connected')
+            cmds.append('SOUR:AM:STAT OFF')
+        return cmds
 
     # move mirror ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -463,10 +789,12 @@ class SPIMMM:
         # this will also cause an error if anything but a number comes in
         try:
             count = int(count)
+            self.mrc = count
             #print('hey')
-            self.seriallock.acquire()
-            self.ard.write('DAC ' + str(count) + '\r')
-            self.seriallock.release()
+            if self.bin:
+                self.sendframe(binproto.DAC, [count])
+            else:
+                self.send('DAC ' + str(count))
             # resp = self.ard.readline()  # ]
             # print(resp)
             # while resp!="o\n":
@@ -481,6 +809,15 @@ class SPIMMM:
     # move stage ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def stage(self, position):
+        cmd = self.stagecmd(position)
+        if cmd is None:
+            return
+        if self.bin and cmd.startswith('STA'):
+            self.sendframe(binproto.STA, [binproto.tonm(self.pos)])
+        else:
+            self.send(cmd)
+
+    def stagecmd(self, position):
         # the PI stage only takes arguments up to the nearest nanometer,
         # this will also cause an error if anything but a number comes in
         # NOTE: for moves >10um, this operation takes at least 2.5s
@@ -491,13 +828,17 @@ class SPIMMM:
                 return
             distance = abs(position - self.pos)
             self.pos = position
-            # if the distance is over 10 microns, move slowly, otherwise move fast
-            self.seriallock.acquire()
-            if distance >= 0.010:
-                self.ard.write('STS ' + str(self.pos) + '\r')
+            # if the distance is over 10 microns, move slowly, otherwise move fast, unless the stage has been
+            # calibrated, in which case the faster of the modes known to manage the distance is used
+            mode = motion.choose(self.mtm, distance) if self.mtm else None
+            if mode is not None:
+                slow = mode == 'STS'
             else:
-                self.ard.write('STA ' + str(self.pos) + '\r')
-            self.seriallock.release()
+                slow = distance >= 0.010
+            if slow:
+                return 'STS ' + str(self.pos)
+            else:
+                return 'STA ' + str(self.pos)
         except TypeError:
             print('error: position value not a float')
 
@@ -505,43 +846,42 @@ class SPIMMM:
 
     def get_pos(self):
         # return the position of the PI stage in mm
-        self.seriallock.acquire()
-        self.ard.write('QRP\r')
-        self.seriallock.release()
-        resp = self.ard.readline()
-        self.pos = float(resp)
+        if self.bin:
+            resp = self.queryframe(binproto.QRP)
+            if resp is not None:
+                resp = binproto.tomm(resp[0])
+        else:
+            resp = self.query('QRP', 'float')
+        if resp is None:
+            print('stage poll error')
+        else:
+            self.pos = resp
+            self.hist.add(time.time(), pos=resp)
+        return self.pos
 
     # halt stage ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def hlt(self):
         # trigger the halt command on the PI stage
-        self.seriallock.acquire()
-        self.ard.write('STP ' + '\r')
-        self.seriallock.release()
+        self.send('STP ')
 
     # reboot stage ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def rbt(self):
         # trigger the reboot command on the PI stage
-        self.seriallock.acquire()
-        self.ard.write('RBT ' + '\r')
-        self.seriallock.release()
+        self.send('RBT ')
 
     # engage stage ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def engage(self):
         # trigger the reboot command on the PI stage
-        self.seriallock.acquire()
-        self.ard.write('ENG ' + '\r')
-        self.seriallock.release()
+        self.send('ENG ')
 
     # disengage stage ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def disengage(self):
         # trigger the reboot command on the PI stage
-        self.seriallock.acquire()
-        self.ard.write('DNG ' + '\r')
-        self.seriallock.release()
+        self.send('DNG ')
 
     # take frame ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -550,9 +890,7 @@ class SPIMMM:
         try:
             cam = int(cam)
             length = int(length)
-            self.seriallock.acquire()
-            self.ard.write('FRM ' + str(cam) + ' ' + str(length) + '\r')
-            self.seriallock.release()
+            self.send('FRM ' + str(cam) + ' ' + str(length))
         except ValueError:
             print('frame length set incorrectly')
 
@@ -560,8 +898,10 @@ class SPIMMM:
 
     def focus(self, location):
         # the command order here is important! See Stage
-        self.mirror(self.stm(location))
-        self.stage(location)
+        # both commands are written together, so that the stage and mirror move as close together as possible
+        with self.io.batch():
+            self.mirror(self.stm(location))
+            self.stage(location)
 
     # calculate mirror count for focus ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -581,62 +921,137 @@ class SPIMMM:
     # extrapolate conservative estimate of large stage movement time ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def pau(self, stage_move):
-        pause = self.smt * (stage_move / self.ste)
+        mode = motion.choose(self.mtm, stage_move) if self.mtm else None
+        if mode is not None:
+            pause = 1000 * float(motion.movetime(self.mtm[mode], stage_move))
+        else:
+            pause = self.smt * (stage_move / self.ste)
         pause = round(pause, 6)
         return pause
 
+    def calibratemotion(self, name, distances=motion.DISTANCES, repeats=3):
+        return motion.run(self, name, distances, repeats)
+
     # take a volume ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    # the acknowledgement of the volume arrives on the returned future when the volume is complete. it is given the time
+    # the arduino takes for a volume, one frame period per slice, and vto seconds more, before it times out
+
     def tkv(self):
-        self.ard.flushInput()
-        self.seriallock.acquire()
-        self.ard.write('RUN\r')
-        self.seriallock.release()
+        self.vst.send()
+        return self.io.submit('RUN\r', 'volume', timeout=self.volumetime() + self.vto)
 
     # take multiple volumes in a row
     def tkvm(self):
-        self.ard.flushInput()
-        self.seriallock.acquire()
-        self.ard.write('RUNM\r')
-        self.seriallock.release()
+        volumes = max(int(self.num_frame), 1)
+        self.vst.send(volumes)
+        return self.io.submit('RUNM\r', 'volume', lines=volumes, timeout=volumes * self.volumetime() + self.vto)
+
+    def volumetime(self):
+        return len(zscan.positions(self.dlo, self.dup, self.ste)) * 0.001 * self.frt
+
+    # returns the acknowledgement, a list of them for tkvm, or None if they did not all arrive. the latency of the
+    # volumes of tkvm is shared between them. the wait is bounded by the timeout of the volumes, with vto seconds more
+    # for the command to be written, in case the reactor stops before it times out
+    def waitvol(self, future):
+        resp = future.result(future.timeout + self.vto)
+        for line in list(future.lines):
+            try:
+                count = int(line.split(',')[1])
+            except (IndexError, ValueError):
+                count = None
+            if future.sent is None or future.received is None:
+                self.vst.done(None, count)
+            else:
+                self.vst.done((future.received - future.sent) / future.count, count)
+        if resp is None:
+            self.vst.timeout(future.count - len(future.lines))
+            print('warning: volume not acknowledged')
+        return resp
+
+    # the plan is cached, so it is only worked out again when one of its parameters changes
+    def scanplan(self, cam=0):
+        return zscan.cached(self.dlo, self.dup, self.ste, self.slp, self.posadj, self.smt, self.exp, self.frt,
+                            self.pos, cam, self.bin, self.mtm)
+
+    # each move and frame of the plan is written at its deadline, counted from the start of the scan, so a late slice
+    # does not make the ones after it late. the next move starts as soon as the exposure before it ends. returns the
+    # planned and the actual seconds from the start at which each frame was triggered, or None if the volume could not
+    # be planned. the actual time is when the reactor wrote the trigger to the port. if it was already written when
+    # submit returned, as by an io that handles commands at once, or was never written, the time submit returned is used
+    def scan(self, cam=0):
+        plan = self.scanplan(cam)
+        if plan is None:
+            return None
+        self.scs = timing.LoopStats('z scan')
+        frames = []
+        start = timing.clock()
+        for move, moveat, trigger in zip(plan['moves'], plan['moveat'], plan['trigger']):
+            timing.sleepuntil(start + moveat, self.spn)
+            self.io.submit(move)
+            timing.sleepuntil(start + trigger, self.spn)
+            future = self.io.submit(plan['frame'])
+            submitted = timing.clock() - start
+            frames.append((None if future.done() else future, submitted))
+        triggered = []
+        for trigger, (future, submitted) in zip(plan['trigger'], frames):
+            if future is not None:
+                future.result(future.timeout)
+            actual = submitted if future is None or future.sent is None else future.sent - start
+            self.scs.act(trigger, actual)
+            triggered.append(actual)
+        self.pos = float(plan['pos'][-1])
+        if self.dbg:
+            print(self.scs.report())
+        return plan['trigger'], triggered
 
     # reset error state from the stage ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def err(self):
-        self.ard.flushInput()
-        self.seriallock.acquire()
-        self.ard.write('ERR\r')
-        resp = self.ard.readline()
-        resp = resp + self.ard.readline()
-        self.seriallock.release()
+        resp = self.query('ERR', lines=2)
+        if resp is None:
+            print('error: no response from stage')
+            return
+        resp = '\n'.join(resp)
         print(resp)
         return resp
 
     # push heater parameters ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def sdh(self):
-        self.seriallock.acquire()
-        self.ard.write('STH\r')
-        self.seriallock.release()
+        self.send('STH')
 
     # read heater parameters ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def rdh(self):
-        self.ard.flushInput()
-        self.seriallock.acquire()
-        self.ard.write('RDH\r')
-        self.seriallock.release()
-        resp = self.ard.readline()
-        if 'END' in resp:
-            return resp
-        else:
+        resp = self.readheater()
+        while resp is None:
             print('temperature poll error')
             time.sleep(0.1)
-            self.rdh()
+            resp = self.readheater()
+        return resp
+
+    def readheater(self):
+        if not self.bin:
+            return self.query('RDH', 'heater')
+        resp = self.queryframe(binproto.RDH)
+        if resp is not None:
+            resp = telemetry.HeaterSample(*resp)
+        return resp
 
     # read heater parameters and control temperature~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def clt(self):
+        self.tcalc()
+
+        # send the parameters and push to the heater
+        with self.io.batch():
+            self.sendcfg()
+            self.sdh()
+
+    # calculate the heater parameters from the last heater response ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def tcalc(self):
 
         # count is the number of polling periods that the bath must within +- 1 degree of the set point to be on
         # target
@@ -645,29 +1060,14 @@ class SPIMMM:
 
         count = 100
         maxsig = 799
-        coolingfactor = 0.75
-
-        maxers = maxsig / self.tki
-
-        # extract measured temperature from readout we may want to refactor the extraction as a function that takes a
-        # keyword and a string, and returns the value of the argument after it, though given that we're dealing with
-        # mixed data types, this might be more difficult than it is useful paramstring = "$HC,MODE,1,PWM,400,TEMP,
-        # 26.5,END"
-
-        paramstring = self.tcr
-        kwtemp = [match.start() for match in re.finditer(re.escape('TEMP'), paramstring)]
-        delimiters = [match.start() for match in re.finditer(re.escape(','), paramstring)]
-        position = filter(lambda x: x >= kwtemp[0], delimiters)
-        position = position[0:2]
-        position[0] = position[0] + 1
-        tempstring = paramstring[position[0]:position[1]]
-        if "." in tempstring:
-            self.tempm = float(tempstring)
-        else:
-            self.tempm = int(tempstring)
+        coolingfactor = self.tcf
+
+        # the measured temperature was decoded from the readout when it arrived
+        self.tempm = self.tcr.temp
 
         # calculate the error and set the parameters
         temperror = self.tem - self.tempm
+        step = self.controlstep()
 
         # this block checks to see if the controller is on target by checking if the temperature has gone out of
         # range recently
@@ -681,24 +1081,35 @@ class SPIMMM:
             count = 10
             self.ont = False
 
-        # block to prevent integrator wind-up
+        saturated = (self.htm == 2 and self.hpw >= maxsig and temperror > 0) or \
+                    (self.htm == 1 and self.hpw >= maxsig * coolingfactor and temperror < 0)
 
-        if abs(temperror) < 8:
-            self.ers = self.ers + (temperror * self.ttc)
+        if self.tcm == 'ffgs':
+            signal, pterm, iterm = self.ffgs(temperror, saturated, maxsig, step)
         else:
-            self.ers = 0
+            # block to prevent integrator wind-up
 
-        if self.ers > maxers:
-            self.ers = maxers
-        elif self.ers < 0:
-            self.ers = 0
+            maxers = maxsig / self.tki
+
+            if abs(temperror) >= self.twl:
+                self.ers = 0
+            elif not (self.taw == 'hold' and saturated):
+                self.ers = self.ers + (temperror * step)
+
+            if self.ers > maxers:
+                self.ers = maxers
+            elif self.ers < 0:
+                self.ers = 0
+
+            if temperror < 0:
+                pterm = temperror * self.tkpc
+            else:
+                pterm = temperror * self.tkp
+            iterm = self.ers * self.tki
+            signal = pterm + iterm
 
         if self.tst:
             signal = 500
-        elif temperror < 0:
-            signal = (temperror * self.tkpc) + (self.ers * self.tki)
-        else:
-            signal = (temperror * self.tkp) + (self.ers * self.tki)
 
         if signal > maxsig:
             signal = maxsig
@@ -707,6 +1118,8 @@ class SPIMMM:
 
         self.hpw = abs(signal)
 
+        self.hist.add(self.tcr.time, tem=self.tem, pterm=pterm, iterm=iterm)
+
         if signal >= 0:
             self.htm = 2
             self.fnm = 0
@@ -717,71 +1130,147 @@ class SPIMMM:
 
         if self.dbg:
             print('demand temperature: ' + str(self.tem) + ', ' + 'measured temperature: ' + str(self.tempm))
-            print('proportional signal: ' + str(temperror * self.tkp) + ', ' + 'integral signal: '
-                  + str((self.ers * self.tki)))
+            print('proportional signal: ' + str(pterm) + ', ' + 'integral signal: ' + str(iterm))
             print('signal: ' + str(signal) + ', ' + 'heater power: ' + str(self.hpw) + ', ' + 'heater mode: ' + str(
                 self.htm))
             if self.ont:
                 print('on target')
 
-        # set the peltier duty cycle and throttle down to the maximum set above
+    # feedforward and gain scheduled control ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # the feedforward is the pwm that holds the setpoint against ambient in the steady state, so after a setpoint change
+    # the heater goes straight to about the power it will need, and the PI terms only correct what the model gets
+    # wrong. the integrator is signed here and is held, not reset, while the output is saturated, so a large step
+    # does not throw away the trim it has learnt. returns the signal and its proportional and integral terms
+
+    def ffgs(self, temperror, saturated, maxsig, step):
+        kp, kpc, ki = self.schedule(self.tem)
+        if not saturated:
+            self.ers = self.ers + (temperror * step)
+        maxers = maxsig / ki if ki else 0
+        self.ers = min(max(self.ers, -maxers), maxers)
+        pterm = temperror * (kpc if temperror < 0 else kp)
+        iterm = self.ers * ki
+        return self.feedforward(self.tem) + pterm + iterm, pterm, iterm
+
+    # the time between the samples acted on, so the integral is right whether the controller runs every ttc seconds or
+    # on every tdc-th sample, and as the poll period changes. the nominal period is used the first time, or if the
+    # sample has not changed since
+    def controlstep(self):
+        last = self.tat
+        self.tat = self.tcr.time
+        if last is not None and self.tcr.time > last:
+            return self.tcr.time - last
+        return self.plp * self.tdc if self.tev else self.ttc
+
+    def feedforward(self, setpoint):
+        if setpoint >= self.amb:
+            return (setpoint - self.amb) / self.tgh
+        return -(self.amb - setpoint) / self.tgc
+
+    def schedule(self, setpoint):
+        if not self.tgt:
+            return self.tkp, self.tkpc, self.tki
+        for bound, kp, kpc, ki in self.tgt:
+            if setpoint <= bound:
+                return kp, kpc, ki
+        return self.tgt[-1][1:]
+
+    # check the temperature has settled ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # read from the history of the heater poll, so the board is not polled again
+
+    def steady(self, seconds=10, band=1.0):
+        times, temps = self.hist.last('temp', seconds, time.time())
+        return len(temps) > 0 and bool(abs(temps - self.tem).max() <= band)
+
+    # tune the temperature controller ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # see autotune; this blocks until both step tests are done
+
+    def autotune(self, name, power=400, duration=900):
+        return autotune.run(self, name, power, duration)
+
+    # use a saved profile ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def useprofile(self, name):
+        profile = profiles.load(name)
+        if not profile:
+            print('warning: no profile named ' + name)
+            return
+        for section, fields in PROFILEFIELDS.items():
+            values = profile.get(section, {})
+            for field in fields:
+                if field in values:
+                    setattr(self, field, values[field])
+        self.off = int(self.posadj * self.slp)
+        # before the ports are open, the configuration is sent once they are
+        if self.io is not None:
+            self.sendcfg()
+        print('profile ' + name + ' in use')
 
-        # send the parameters and push to the heater
+    # calibrate the mirror against the stage ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def setcal(self, slp, posadj):
+        self.slp = slp
+        self.posadj = posadj
+        self.off = int(self.posadj * self.slp)
         self.sendcfg()
-        self.sdh()
+
+    def calpoint(self):
+        point = (self.get_pos(), self.mrc)
+        self.cpt.append(point)
+        print('point ' + str(len(self.cpt)) + ': position ' + str(point[0]) + ', count ' + str(point[1]))
+        return point
+
+    def makecal(self, objective, holder):
+        return calib.run(self, objective, holder)
 
     # set the current channels ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def setmag(self):
-        self.seriallock.acquire()
-        self.ard.write('STM\r')
-        self.seriallock.release()
+        self.send('STM')
 
     # set the white led intensity ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def setled(self):
-        self.seriallock.acquire()
-        self.ard.write('LON\r')
-        self.seriallock.release()
+        self.send('LON')
 
     # read the magnet system state ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def readmag(self):
-        self.seriallock.release()
-        self.ard.write('RDM\r')
-        self.seriallock.release()
-        resp = self.ard.readline()
-        if 'END' in resp:
-            return resp
-        else:
+        resp = self.query('RDM', 'magnet')
+        if resp is None:
             print('magnet poll error')
+        else:
+            self.hist.add(resp.time, cur1=resp.cur1, cur2=resp.cur2, cur3=resp.cur3, cur4=resp.cur4)
+        return resp
 
     # trigger the magnet controller on or off in software ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def trigmag(self, trigger=0):
-        self.seriallock.acquire()
         if trigger:
-            self.ard.write('TRS\r')
+            self.send('TRS')
         else:
-            self.ard.write('KLS\r')
-        self.seriallock.release()
+            self.send('KLS')
 
     # run camera ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # note that the sleep parameter includes the exposure time
+    # a frame is triggered every frt milliseconds, counted from the first, and the exposure runs within the period
 
     def actcam(self, cam):
         print('camera started')
+        if self.exp > self.frt:
+            print('warning: exposure longer than the frame period')
 
         self.camera_halt.clear()
+        self.cms = timing.Periodic(0.001 * self.frt, self.cmp, self.spn, 'camera')
         while not self.camera_halt.isSet():
+            self.cms.wait()
             self.frame(cam, self.exp)
-            time.sleep(self.frt - (0.001 * self.exp))
+        print(self.cms.report())
 
-    def startcam(self):
+    def startcam(self, cam=0):
         if self.camera.isAlive():
             print('warning: thread already running')
         else:
-            self.camera = threading.Thread(name='camera', target=self.actcam)
+            self.camera = threading.Thread(name='camera', target=self.actcam, args=(cam,))
             self.camera.start()
 
     def haltcam(self):
@@ -794,6 +1283,65 @@ class SPIMMM:
             else:
                 print('warning: flag not set')
 
+    # run several channels ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # the laser power is set once at the start, after which a switch of channel only turns lasers on and off. in frame
+    # mode the switch to the next channel is written as soon as the exposure ends rather than at the next trigger, so
+    # that it is done by then. the lasers are left as lst1 and lst2 set them when the acquisition halts
+
+    def actmulti(self):
+        print('multi-channel acquisition started')
+        states = [tuple(channel[2:4]) for channel in self.chn]
+        table = channels.switches(states)
+        sequence = channels.order(len(self.chn) * self.che, len(self.chn), self.che)
+        self.chs = channels.ChannelStats([channel[0] for channel in self.chn])
+
+        self.writelasers(*[''.join(cmd + '\r' for cmd in cmds) for cmds in
+                           (self.lasercmds(self.pwr1, states[sequence[0]][0], '488nm'),
+                            self.lasercmds(self.pwr2, states[sequence[0]][1], '561nm'))])
+        self.multi_halt.clear()
+        ticker = timing.Periodic(0.001 * self.frt, self.cmp, self.spn, 'multi-channel')
+        index = 0
+        while not self.multi_halt.isSet():
+            current = sequence[index % len(sequence)]
+            upcoming = sequence[(index + 1) % len(sequence)]
+            name, cam = self.chn[current][:2]
+            if self.chm == 'volume':
+                scanned = self.scan(cam)
+                if scanned is None:
+                    break
+                self.chs.add(name, len(scanned[1]))
+            else:
+                deadline = ticker.wait()
+                self.frame(cam, self.exp)
+                self.chs.add(name)
+                timing.sleepuntil(deadline + 0.001 * self.exp, self.spn)
+            self.writelasers(*table[current, upcoming])
+            index += 1
+        self.writelasers(*channels.switch(None, (self.lst1, self.lst2)))
+        print(self.chs.report())
+
+    def writelasers(self, cmd1, cmd2):
+        for port, cmd in ((self.las1, cmd1), (self.las2, cmd2)):
+            if cmd and port.isOpen():
+                self.sendlaser(port, cmd)
+
+    def startmulti(self):
+        if self.multi.isAlive():
+            print('warning: thread already running')
+        else:
+            self.multi = threading.Thread(name='multi', target=self.actmulti)
+            self.multi.start()
+
+    def haltmulti(self):
+        if not self.multi.isAlive():
+            print('warning: multi-channel acquisition not running')
+        else:
+            if not self.multi_halt.isSet():
+                self.multi_halt.set()
+                print('multi-channel acquisition halted')
+            else:
+                print('warning: flag not set')
+
     # run temperature control ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def acttempcont(self):
@@ -805,16 +1353,47 @@ class SPIMMM:
             time.sleep(0.5)
 
         print('temperature controller running')
+        self.tls = timing.LoopStats('temperature control')
         self.tempcont_halt.clear()
+        if self.tev:
+            self.tempevents()
+        else:
+            while not self.tempcont_halt.isSet():
+                sample = self.tcr
+                self.clt()
+                self.tls.act(sample.time, time.time())
+                time.sleep(self.ttc)
+        print(self.tls.report())
+
+    # wait for each fresh sample from the poll and act on every tdc-th one, so the controller neither acts on a stale
+    # sample nor twice on the same one. samples that arrive while clt is running are counted as skipped
+    def tempevents(self):
+        seen = self.seq
+        count = 0
         while not self.tempcont_halt.isSet():
+            with self.fresh:
+                if self.seq == seen:
+                    # wake up now and then to check the halt flag, in case the poll has stopped
+                    self.fresh.wait(max(10 * self.plp, 0.5))
+                if self.seq == seen:
+                    continue
+                if self.seq - seen > 1:
+                    self.tls.skip(self.seq - seen - 1)
+                seen = self.seq
+                sample = self.tcr
+            count += 1
+            if count < self.tdc:
+                continue
+            count = 0
             self.clt()
-            time.sleep(self.ttc)
+            self.tls.act(sample.time, time.time())
 
     def starttempcont(self):
         if self.tempcont.isAlive():
             print('warning: thread already running')
         else:
             self.ers = 0
+            self.tat = None
             self.tempcont = threading.Thread(name='tempcont', target=self.acttempcont)
             self.tempcont.start()
 
@@ -831,8 +1410,9 @@ class SPIMMM:
         # shut the heater controller down
         self.htm = 0
         self.fnm = 0
-        self.sendcfg()
-        self.sdh()
+        with self.io.batch():
+            self.sendcfg()
+            self.sdh()
         self.temppoll_halt.set()
 
     # run temperature logging ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -848,14 +1428,23 @@ class SPIMMM:
         print('temperature logging running')
         timestr = time.strftime('%Y%m%d-%H%M%S')
         contstring = 'Kp' + '_' + str(self.tkp) + '_' + 'Ki' + '_' + str(self.tki)
-        templogname = 'templog_' + timestr + '_' + contstring + '.csv'
+        templogname = 'templog_' + timestr + '_' + contstring
         templogname = 'templog/' + templogname
-        templogfile = open(templogname, 'a')
-        templogfile.write('Device,,Mode,,PWM,,Temp,,\n')
 
         self.templog_halt.clear()
+        if self.lgf == 'bin':
+            templogfile = binlog.ColumnLog(templogname + '.splg')
+            while not self.templog_halt.isSet():
+                sample = self.tcr
+                templogfile.append(sample.time, sample.temp, self.tem, sample.pwm, sample.mode)
+                time.sleep(self.lgp)
+            templogfile.close()
+            return
+
+        templogfile = open(templogname + '.csv', 'a')
+        templogfile.write('Device,,Mode,,PWM,,Temp,,\n')
         while not self.templog_halt.isSet():
-            templogfile.write(self.tcr.rstrip() + ',' + 'SET TEMP' + ',' + str(self.tem) + ',' + 'SYS TIME' + ','
+            templogfile.write(str(self.tcr) + ',' + 'SET TEMP' + ',' + str(self.tem) + ',' + 'SYS TIME' + ','
                               + str(time.time()) + '\n')
             time.sleep(self.lgp)
         templogfile.close()
@@ -887,17 +1476,39 @@ class SPIMMM:
                 self.open_ports()
                 print('ports opened successfully')
             except UserWarning:
-                print('ports unreachable, releasing thread locks in 2 seconds')
-                time.sleep(2)
-                self.seriallock.release()
+                print('ports unreachable')
                 return
 
+        self.pls = timing.PollStats('temperature poll', self.plp)
+        period = self.plp
         self.temppoll_halt.clear()
         while not self.temppoll_halt.isSet():
-            self.tcr = self.rdh()
+            sent = time.time()
+            sample = self.rdh()
+            with self.fresh:
+                self.tcr = sample
+                self.seq += 1
+                self.fresh.notify_all()
+            self.hist.add(sample.time, temp=sample.temp, pwm=sample.pwm, mode=sample.mode)
             self.data_in.set()
-            time.sleep(self.plp)
+            period = self.pollperiod(period) if self.apl else self.plp
+            self.pls.poll(sample.time - sent, period)
+            time.sleep(period)
         self.data_in.clear()
+        print(self.pls.report())
+
+    # the next polling period: back to plp as soon as the temperature moves, or the controller is off target, and
+    # otherwise half as long again as the last, up to plx. stability is judged from the history, so the 0.01 degree
+    # steps of the readout do not count as movement
+    def pollperiod(self, period):
+        if self.volume_running.isSet():
+            return self.plx
+        temps = self.hist.last('temp', self.tpw)[1]
+        if not len(temps) or temps.max() - temps.min() > self.tps:
+            return self.plp
+        if self.tempcont.isAlive() and not self.ont:
+            return self.plp
+        return min(period * 1.5, self.plx)
 
     def starttemppoll(self):
         if self.temppoll.isAlive():
@@ -944,12 +1555,65 @@ class SPIMMM:
 
     # take volume ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def actvol(self):
+    # volumes are taken back to back, or for 'duration' seconds at the pace of vrt if it is given
+    def actvol(self, duration=None):
         self.sendcfg()
         print('microscope running')
         self.volume_halt.clear()
-        while not self.volume_halt.isSet():
-            self.tkv()
+        self.volume_running.set()
+        self.vst = timing.VolumeStats('volumes')
+        if duration is None:
+            while not self.volume_halt.isSet():
+                # wait for each volume to be acknowledged rather than filling the command queue
+                self.waitvol(self.tkv())
+        else:
+            self.lapse(duration)
+        self.volume_running.clear()
+        print(self.vst.report())
+
+    # the volumes are started on deadlines every vrt seconds from the first, so the time-lapse does not drift
+    def lapse(self, duration):
+        self.vlr = []
+        self.vls = timing.LoopStats('time-lapse')
+        top = self.dup
+        start = timing.clock()
+        planned = 0.0
+        while planned < duration:
+            # a long wait is spent on the halt flag, so that the time-lapse can be halted between volumes
+            if self.volume_halt.wait(max(start + planned - timing.clock() - self.spn, 0)):
+                break
+            timing.sleepuntil(start + planned, self.spn)
+            began = timing.clock()
+            acknowledged = self.waitvol(self.tkv()) is not None
+            took = timing.clock() - began
+            self.vls.act(start + planned, began)
+            record = {'planned': planned, 'start': began - start, 'duration': took,
+                      'slices': len(zscan.positions(self.dlo, self.dup, self.ste)), 'acknowledged': acknowledged,
+                      'skipped': 0}
+            self.vlr.append(record)
+            planned += self.vrt
+            late = timing.clock() - start - planned
+            if late > 0:
+                if self.vlp == 'skip':
+                    record['skipped'] = int(late // self.vrt) + 1
+                    planned += record['skipped'] * self.vrt
+                    self.vls.skip(record['skipped'])
+                else:
+                    planned += late
+                    if self.vlp == 'shorten':
+                        self.shorten(took, record['slices'])
+        if self.dup != top:
+            self.dup = top
+            self.sendcfg()
+        print(self.vls.report())
+
+    def shorten(self, took, slices):
+        fit = min(max(int(slices * self.vrt / took), 1), slices - 1)
+        if fit < 1:
+            return
+        self.dup = round(self.dlo + (1 if self.dup >= self.dlo else -1) * (fit - 1) * self.ste, 6)
+        print('warning: stack cut to ' + str(fit) + ' slices to fit in vrt')
+        self.sendcfg()
 
     def startvol(self):
         if self.volume.isAlive():
@@ -958,6 +1622,13 @@ class SPIMMM:
             self.volume = threading.Thread(name='volume', target=self.actvol)
             self.volume.start()
 
+    def voltime(self):
+        if self.volume.isAlive():
+            print('warning: thread already running')
+        else:
+            self.volume = threading.Thread(name='volume', target=self.actvol, args=(self.imt,))
+            self.volume.start()
+
     def haltvol(self):
         if not self.volume.is_alive():
             print('warning: volume acquisition not running')
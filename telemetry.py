@@ -0,0 +1,227 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library turns the heater and magnet responses of the arduino into typed records in a
+# single pass, so that the controller, the logger and any analysis use the same values without parsing strings again.
+# it also keeps a fixed size history of each telemetry channel, so that recent values can be read back as arrays.
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# threading is used to guard the history, which is written and read from different threads
+# time is used to stamp each record as it is decoded
+# numpy holds the history of each channel
+
+import threading
+import time
+
+import numpy as np
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# HeaterSample - one heater reading: mode (0 off, 1 cool, 2 heat), pwm, temperature in degrees C and the time it arrived
+#
+# MagnetSample - one magnet reading: the four coil currents in mA, the trigger state and the led intensity
+#
+# Decoder - decodes the keyword,value lines of one record type
+#
+# RingBuffer - the last 'capacity' time stamped values of one channel
+#
+# History - a ring buffer for each of the CHANNELS
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# heater - decode a heater line, $HC,MODE,1,PWM,400,TEMP,26.5,END
+#
+# magnet - decode a magnet line, $MC,CUR1,0,CUR2,0,CUR3,0,CUR4,0,TRIG,0,LED,0,END
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# CHANNELS - the channels kept in a History: measured temperature, setpoint, heater pwm and mode, the proportional and
+# integral terms of the controller, stage position and the four coil currents
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+# records ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# printing a record gives back the line in the arduino's format, which is what the temperature logs hold
+
+class HeaterSample(object):
+    __slots__ = ('mode', 'pwm', 'temp', 'time')
+
+    def __init__(self, mode=0, pwm=0, temp=0.0, stamp=None):
+        self.mode = mode
+        self.pwm = pwm
+        self.temp = temp
+        self.time = time.time() if stamp is None else stamp
+
+    def __str__(self):
+        return '$HC,MODE,{0},PWM,{1},TEMP,{2:.2f},END'.format(self.mode, self.pwm, self.temp)
+
+    __repr__ = __str__
+
+
+class MagnetSample(object):
+    __slots__ = ('cur1', 'cur2', 'cur3', 'cur4', 'trig', 'led', 'time')
+
+    def __init__(self, cur1=0, cur2=0, cur3=0, cur4=0, trig=0, led=0, stamp=None):
+        self.cur1 = cur1
+        self.cur2 = cur2
+        self.cur3 = cur3
+        self.cur4 = cur4
+        self.trig = trig
+        self.led = led
+        self.time = time.time() if stamp is None else stamp
+
+    def __str__(self):
+        return '$MC,CUR1,{0},CUR2,{1},CUR3,{2},CUR4,{3},TRIG,{4},LED,{5},END'.format(
+            self.cur1, self.cur2, self.cur3, self.cur4, self.trig, self.led)
+
+    __repr__ = __str__
+
+
+# decoders ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# fields maps each keyword in the line to the record attribute and its type. the position of each value is learnt
+# from the first line and reused while the layout stays the same, so a line costs one split; a line with a different
+# layout is read by keyword and its layout learnt in turn. keywords that are not known are ignored, but a line that is
+# missing any of the fields raises a ValueError, so that it is dropped rather than read as a record of defaults
+
+class Decoder:
+
+    def __init__(self, record, fields):
+        self.record = record
+        self.fields = fields
+        self.layout = None
+        self.keys = {}
+        self.width = 0
+
+    def __call__(self, line):
+        parts = line.strip().split(',')
+        if len(parts) != self.width or not self.matches(parts):
+            self.learn(parts)
+        sample = self.record()
+        for index, name, kind in self.layout:
+            setattr(sample, name, kind(parts[index]))
+        return sample
+
+    def matches(self, parts):
+        for index, name, kind in self.layout:
+            if parts[index - 1] != self.keys[name]:
+                return False
+        return True
+
+    def learn(self, parts):
+        self.layout = []
+        self.keys = {}
+        for index in range(1, len(parts) - 1):
+            field = self.fields.get(parts[index])
+            if field is not None:
+                self.layout.append((index + 1, field[0], field[1]))
+                self.keys[field[0]] = parts[index]
+        self.width = len(parts)
+        missing = [keyword for keyword, field in self.fields.items() if field[0] not in self.keys]
+        if missing:
+            # forget the layout, so that the next line of the same width is learnt again rather than trusted
+            self.width = 0
+            raise ValueError('line is missing ' + ', '.join(sorted(missing)))
+
+
+def whole(value):
+    # a pwm sent from a float setting arrives as e.g. '412.5'
+    return int(float(value))
+
+
+heater = Decoder(HeaterSample, {'MODE': ('mode', int), 'PWM': ('pwm', whole), 'TEMP': ('temp', float)})
+
+magnet = Decoder(MagnetSample, {'CUR1': ('cur1', int), 'CUR2': ('cur2', int), 'CUR3': ('cur3', int),
+                                'CUR4': ('cur4', int), 'TRIG': ('trig', int), 'LED': ('led', int)})
+
+
+# history ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# each channel is a pair of preallocated arrays written in a circle, so the memory used is fixed however long the rig
+# runs and the oldest values are overwritten first. values are assumed to arrive in time order, which lets a time
+# window be found by bisection rather than by scanning. queries return copies, in time order
+
+CHANNELS = ('temp', 'tem', 'pwm', 'mode', 'pterm', 'iterm', 'pos', 'cur1', 'cur2', 'cur3', 'cur4')
+
+
+class RingBuffer:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.zeros(capacity)
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, stamp, value):
+        self.times[self.head] = stamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    # the index of the oldest value, and of the one after the newest, in the unwrapped order
+    def span(self):
+        return self.head - self.count, self.head
+
+    def ordered(self, array, first, last):
+        # first may be negative, in which case the window wraps round the end of the array
+        if first >= 0:
+            return array[first:last].copy()
+        return np.concatenate((array[first:], array[:last]))
+
+    def all(self):
+        first, last = self.span()
+        return self.ordered(self.times, first, last), self.ordered(self.values, first, last)
+
+    def latest(self):
+        if not self.count:
+            return None, None
+        return self.times[self.head - 1], self.values[self.head - 1]
+
+    # the values stamped at or after 'since'
+    def since(self, since):
+        first, last = self.span()
+        if first < 0:
+            # the older values are at the end of the arrays, the newer ones at the start
+            older = self.times[first:]
+            split = int(np.searchsorted(older, since))
+            if split < len(older):
+                first += split
+            else:
+                first = int(np.searchsorted(self.times[:last], since))
+        else:
+            first += int(np.searchsorted(self.times[first:last], since))
+        return self.ordered(self.times, first, last), self.ordered(self.values, first, last)
+
+    # the values of the last 'seconds', counted back from 'now' or from the newest value
+    def last(self, seconds, now=None):
+        if now is None:
+            now = self.latest()[0] if self.count else 0.0
+        return self.since(now - seconds)
+
+
+class History:
+
+    def __init__(self, capacity=100000, channels=CHANNELS):
+        self.lock = threading.Lock()
+        self.buffers = dict((name, RingBuffer(capacity)) for name in channels)
+
+    def __getitem__(self, name):
+        return self.buffers[name]
+
+    # record values for any of the channels at one time, e.g. hist.add(sample.time, temp=26.5, pwm=400)
+    def add(self, stamp, **values):
+        with self.lock:
+            for name, value in values.items():
+                self.buffers[name].append(stamp, value)
+
+    def last(self, name, seconds, now=None):
+        with self.lock:
+            return self.buffers[name].last(seconds, now)
+
+    def since(self, name, since):
+        with self.lock:
+            return self.buffers[name].since(since)
@@ -0,0 +1,210 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library analyses the temperature logs in bulk. each log is loaded into arrays, split at
+# every change of setpoint, and the step responses are measured, so that the controller settings the logs were taken
+# with, which are written in their file names, can be compared and ranked. logs are analysed in parallel, one per
+# process. for example, from the command line:
+#
+#   python tempanal.py templog/*.csv templog/*.splg
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# multiprocessing runs the analysis of each log in its own process
+# os and re are used to read the controller settings from the file names
+# sys is used to take the file names from the command line
+# numpy holds the logs and does the analysis
+# binlog reads the binary column logs
+
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy as np
+
+import binlog
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# MAXSIG - the largest heater pwm, which is full duty
+#
+# METRICS - the measurements made of each step, see analysestep
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# gains - reads Kp and Ki from the name of a log
+#
+# load - loads a csv or binary temperature log into a dictionary of arrays: time, temp, tem, pwm and mode
+#
+# steps - finds the rows at which the setpoint changes or the controller starts
+#
+# analysestep - measures one step response
+#
+# analysefile - loads a log and measures each of its steps
+#
+# analyse - analyses many logs in parallel and returns the measurements of every step
+#
+# rank - groups the steps by controller settings and orders the settings from best to worst
+#
+# report - prints a ranking as a table
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+MAXSIG = 799.0
+
+METRICS = ('rise', 'overshoot', 'settle', 'sse', 'duty', 'iae')
+
+NAMEGAINS = re.compile(r'Kp_([-+0-9.eE]+)_Ki_([-+0-9.eE]+?)\.(?:csv|splg)$')
+
+
+# loading ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# a csv log line reads $HC,MODE,1,PWM,400,TEMP,26.5,END,SET TEMP,40,SYS TIME,1528712345.6, after the header line.
+# lines cut short, or written while the poll was failing, are left out before the numbers are parsed in one call. a
+# csv exported from a binary log by binlog.tocsv has a header of column names instead, and is read by those names
+
+def gains(path):
+    match = NAMEGAINS.search(os.path.basename(path))
+    if match is None:
+        return None, None
+    return float(match.group(1)), float(match.group(2))
+
+
+def load(path):
+    if path.endswith('.splg'):
+        data = binlog.read(path)
+        return dict((name, data[name].astype(float)) for name in ('time', 'temp', 'tem', 'pwm', 'mode'))
+    with open(path) as logfile:
+        header = logfile.readline().strip().split(',')
+        if set(('time', 'temp', 'tem', 'pwm', 'mode')) <= set(header):
+            lines = [line for line in logfile if line.strip()]
+            if lines:
+                table = np.loadtxt(lines, delimiter=',', ndmin=2)
+                return dict((name, table[:, header.index(name)]) for name in ('time', 'temp', 'tem', 'pwm', 'mode'))
+        else:
+            logfile.seek(0)
+            lines = [line for line in logfile if line.startswith('$HC') and line.count(',') == 11]
+    if not lines:
+        print('warning: no temperature readings in ' + path)
+        return dict((name, np.empty(0)) for name in ('time', 'temp', 'tem', 'pwm', 'mode'))
+    table = np.loadtxt(lines, delimiter=',', usecols=(2, 4, 6, 9, 11), ndmin=2)
+    return {'mode': table[:, 0], 'pwm': table[:, 1], 'temp': table[:, 2], 'tem': table[:, 3], 'time': table[:, 4]}
+
+
+# step responses ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# a step starts where the setpoint changes, or where the heater is first switched on, and runs to the start of the next
+# one. for a step from y0 to the setpoint r:
+#   rise - seconds taken to go from 10% to 90% of the way from y0 to r
+#   overshoot - the furthest the temperature goes past r, as a percentage of the step
+#   settle - seconds until the temperature stays within 'band' degrees of r, nan if it never does
+#   sse - the mean of temperature minus r over the last 'tail' seconds of the step
+#   duty - the mean heater pwm over the step, as a fraction of full power
+#   iae - the integral of the absolute error over the step, divided by the size of the step, in seconds
+
+def steps(data):
+    if not len(data['time']):
+        return np.empty(0, int)
+    changes = np.flatnonzero(np.diff(data['tem']) != 0) + 1
+    active = data['mode'] != 0
+    starts = np.flatnonzero(active[1:] & ~active[:-1]) + 1
+    if len(active) and active[0]:
+        starts = np.append(0, starts)
+    return np.union1d(changes, starts).astype(int)
+
+
+def analysestep(times, temps, pwms, target, band=0.5, tail=60.0, minstep=0.5):
+    start = temps[0]
+    span = target - start
+    if abs(span) < minstep or len(times) < 3:
+        return None
+    elapsed = times - times[0]
+    # progress runs from 0 at the start to 1 at the setpoint, whichever way the step goes
+    progress = (temps - start) / span
+    low = np.flatnonzero(progress >= 0.1)
+    high = np.flatnonzero(progress >= 0.9)
+    rise = elapsed[high[0]] - elapsed[low[0]] if len(low) and len(high) else np.nan
+    overshoot = max(progress.max() - 1.0, 0.0) * 100.0
+    outside = np.flatnonzero(np.abs(temps - target) > band)
+    if not len(outside):
+        settle = 0.0
+    elif outside[-1] == len(temps) - 1:
+        settle = np.nan
+    else:
+        settle = elapsed[outside[-1] + 1]
+    last = elapsed >= elapsed[-1] - tail
+    sse = float(np.mean(temps[last] - target))
+    duty = float(np.mean(pwms)) / MAXSIG
+    error = np.abs(temps - target)
+    iae = float(np.sum(0.5 * (error[1:] + error[:-1]) * np.diff(elapsed)) / abs(span))
+    return {'time': float(times[0]), 'start': float(start), 'target': float(target), 'length': float(elapsed[-1]),
+            'rise': float(rise), 'overshoot': float(overshoot), 'settle': float(settle), 'sse': sse, 'duty': duty,
+            'iae': iae}
+
+
+def analysefile(path, band=0.5, tail=60.0):
+    kp, ki = gains(path)
+    try:
+        data = load(path)
+    except (IOError, ValueError) as error:
+        print('warning: could not read ' + path + ': ' + str(error))
+        return []
+    bounds = np.append(steps(data), len(data['time']))
+    results = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        result = analysestep(data['time'][first:last], data['temp'][first:last], data['pwm'][first:last],
+                             data['tem'][first], band, tail)
+        if result is not None:
+            result.update({'file': path, 'kp': kp, 'ki': ki})
+            results.append(result)
+    return results
+
+
+# this has to be at the top level of the module for the pool to send it to its processes
+def analyseargs(args):
+    return analysefile(*args)
+
+
+def analyse(paths, band=0.5, tail=60.0, processes=None):
+    paths = list(paths)
+    if len(paths) < 2 or processes == 1:
+        return [result for path in paths for result in analysefile(path, band, tail)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        found = pool.map(analyseargs, [(path, band, tail) for path in paths])
+    finally:
+        pool.close()
+        pool.join()
+    return [result for results in found for result in results]
+
+
+# ranking ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# each setting is scored by the mean of 'key' over its steps, lower being better, and steps that never settle count
+# against it. the ranking is a list of dictionaries holding kp, ki, the number of steps and the mean of each metric
+
+def rank(results, key='iae'):
+    groups = {}
+    for result in results:
+        groups.setdefault((result['kp'], result['ki']), []).append(result)
+    ranking = []
+    for (kp, ki), group in groups.items():
+        entry = {'kp': kp, 'ki': ki, 'steps': len(group),
+                 'unsettled': int(np.sum(np.isnan([result['settle'] for result in group])))}
+        for metric in METRICS:
+            values = np.array([result[metric] for result in group])
+            entry[metric] = float(np.nanmean(values)) if np.any(~np.isnan(values)) else np.nan
+        ranking.append(entry)
+    ranking.sort(key=lambda entry: (entry['unsettled'] > 0, np.inf if np.isnan(entry[key]) else entry[key]))
+    return ranking
+
+
+def report(ranking):
+    print('{0:>8} {1:>8} {2:>5} {3:>9} {4:>8} {5:>9} {6:>8} {7:>7} {8:>6} {9:>8}'.format(
+        'Kp', 'Ki', 'steps', 'unsettled', 'rise s', 'overshoot', 'settle s', 'sse', 'duty', 'iae s'))
+    for entry in ranking:
+        print('{0:>8} {1:>8} {2:>5} {3:>9} {4:>8.1f} {5:>8.1f}% {6:>8.1f} {7:>7.2f} {8:>6.2f} {9:>8.1f}'.format(
+            str(entry['kp']), str(entry['ki']), entry['steps'], entry['unsettled'], entry['rise'], entry['overshoot'],
+            entry['settle'], entry['sse'], entry['duty'], entry['iae']))
+
+
+if __name__ == '__main__':
+    report(rank(analyse(sys.argv[1:])))
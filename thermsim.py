@@ -0,0 +1,264 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library simulates the peltier heater and bath on a simulated clock, so that the
+# temperature controller can be developed without the rig. the SPIMMM class runs unchanged against it: the commands it
+# sends are handled by the arduino emulator at once, with its thermal model replaced by the plant here, and the clock
+# only moves when the simulation moves it, so hours run in seconds. for example:
+#
+#   scope = thermsim.simscope(tau=400, dead=8)
+#   scope.tkp = 200
+#   times, temps = thermsim.simulate(scope, 3600, [(0, 37)])
+#
+# many scenarios can be run in parallel with 'scenarios'.
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# collections and math are used by the plant model
+# multiprocessing runs scenarios in parallel
+# numpy holds the results
+# binproto, emulator and serialio provide the simulated arduino and the requests it answers
+# spimmm_obj is the class under test and tempanal measures its step responses
+
+import collections
+import math
+import multiprocessing
+
+import numpy as np
+
+import binproto
+import emulator
+import serialio
+import spimmm_obj
+import tempanal
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# SimClock - the simulated time in seconds, which only moves when advanced
+#
+# PeltierPlant - a first order plus dead time model of the bath, with separate heating and cooling gains and the effect
+# of the fan; it takes the place of emulator.ThermalModel
+#
+# SimIO - stands in for serialio.SerialReactor, answering each command at once from an arduino emulator
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# simscope - makes a SPIMMM that controls a simulated plant
+#
+# simulate - runs the heater poll and the temperature controller of a SPIMMM on the simulated clock
+#
+# scenario - builds and runs one simulation from a dictionary of settings and measures its step responses
+#
+# scenarios - runs many scenarios in parallel
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+# clock ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class SimClock:
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+# plant ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the bath relaxes towards the ambient temperature plus the effect of the heater with time constant tau. heat and cool
+# are the steady state change in degrees C per unit of pwm, and with the fan off only 1 - fan of the cooling is
+# delivered. the heater acts dead seconds after it is set; what the board reports as its mode and pwm changes at once.
+# each step of at most 'step' seconds is solved exactly, so long steps stay stable
+
+class PeltierPlant:
+
+    def __init__(self, clock, temp=21.0, amb=21.0, tau=300.0, heat=0.02, cool=0.012, fan=0.5, dead=5.0, step=0.5):
+        self.clock = clock
+        self.temp = temp
+        self.amb = amb
+        self.tau = tau
+        self.heat = heat
+        self.cool = cool
+        self.fan = fan
+        self.dead = dead
+        self.step = step
+        self.htm = 0
+        self.hpw = 0.0
+        self.fnm = 0
+        self.acting = (0, 0.0, 0)
+        self.inputs = collections.deque()
+        self.last = clock.now
+
+    def target(self):
+        htm, hpw, fnm = self.acting
+        if htm == 2:
+            return self.amb + self.heat * hpw
+        if htm == 1:
+            return self.amb - self.cool * hpw * (1.0 if fnm else 1.0 - self.fan)
+        return self.amb
+
+    def advance(self, now=None):
+        if now is None:
+            now = self.clock.now
+        while self.last < now:
+            # stop at the next input to take effect, so it acts at the right time
+            end = min(now, self.last + self.step)
+            if self.inputs and self.inputs[0][0] < end:
+                end = max(self.inputs[0][0], self.last)
+            self.temp += (self.target() - self.temp) * (1.0 - math.exp(-(end - self.last) / self.tau))
+            self.last = end
+            while self.inputs and self.inputs[0][0] <= self.last:
+                self.acting = self.inputs.popleft()[1]
+
+    def apply(self, htm, hpw, fnm):
+        self.advance()
+        self.htm = int(htm)
+        self.hpw = float(hpw)
+        self.fnm = int(fnm)
+        self.inputs.append((self.clock.now + self.dead, (self.htm, self.hpw, self.fnm)))
+        self.advance()
+
+
+# io ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# commands are handled as they are submitted, so the returned future is already complete. the future and the records
+# that carry a time are stamped with the simulated time, as the history and the controller read it from them
+
+class SimIO:
+
+    def __init__(self, device, clock):
+        self.device = device
+        self.clock = clock
+        self.dropped = 0
+        self.corrupt = 0
+        self.written = 0
+        self.writes = 0
+
+    def submit(self, cmd, kind=None, lines=1, timeout=5.0, reply=None, priority=None):
+        data = cmd if isinstance(cmd, bytes) else cmd.encode('ascii')
+        self.written += len(data)
+        self.writes += 1
+        request = serialio.Future(data, kind, lines, timeout, reply, priority)
+        request.sent = self.clock.now
+        for resp in self.handle(data):
+            if isinstance(resp, bytes) and resp[:1] == bytearray([binproto.SYNC]):
+                for op, values in binproto.decode(resp)[0]:
+                    if not request.done() and request.acceptsframe(op):
+                        request.finish(values)
+                continue
+            line = resp.decode('ascii') if isinstance(resp, bytes) else resp
+            line = line.strip()
+            if kind is not None and not request.done() and request.accepts(line):
+                request.feed(line)
+            else:
+                self.dropped += 1
+        if not request.done():
+            if kind is None:
+                request.finish(None)
+            else:
+                request.expire()
+        request.received = self.clock.now
+        if hasattr(request.value, 'time'):
+            request.value.time = self.clock.now
+        return request
+
+    def handle(self, data):
+        if data[:1] == bytearray([binproto.SYNC]):
+            resps = []
+            for op, values in binproto.decode(data)[0]:
+                resps.extend(self.device.handleframe(op, values))
+            return resps
+        resps = []
+        for line in data.decode('ascii').split('\r'):
+            parts = line.split()
+            if parts:
+                resps.extend(self.device.handle(parts[0], parts[1:]))
+        return resps
+
+    def batch(self):
+        return SimBatch()
+
+
+class SimBatch:
+
+    def __enter__(self):
+        request = serialio.Future(b'')
+        request.finish(None)
+        return request
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+
+# simulation ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the keyword arguments of simscope are those of PeltierPlant
+
+def simscope(**plant):
+    clock = SimClock()
+    device = emulator.ArduinoEmulator(thermal=PeltierPlant(clock, **plant))
+    return spimmm_obj.SPIMMM(io=SimIO(device, clock))
+
+
+# simulate does what acttemppoll and acttempcont do together: the heater is read every plp seconds, and clt is run every
+# ttc seconds, or on every tdc-th sample if tev is set, integrating over the simulated time between the samples it acts
+# on. schedule is a list of (seconds from the start, setpoint) pairs. returns the times and temperatures read
+def simulate(scope, seconds, schedule=()):
+    clock = scope.io.clock
+    start = clock.now
+    scope.tat = None
+    changes = sorted(schedule)
+    nextcontrol = start
+    count = 0
+    while clock.now - start < seconds:
+        while changes and clock.now - start >= changes[0][0]:
+            scope.tem = changes.pop(0)[1]
+        sample = scope.rdh()
+        scope.tcr = sample
+        scope.seq += 1
+        scope.hist.add(sample.time, temp=sample.temp, pwm=sample.pwm, mode=sample.mode)
+        count += 1
+        if scope.tev:
+            if count >= scope.tdc:
+                count = 0
+                scope.clt()
+        elif clock.now >= nextcontrol:
+            scope.clt()
+            nextcontrol += scope.ttc
+        clock.advance(scope.plp)
+    return scope.hist.since('temp', start)
+
+
+# settings is a dictionary with any of: 'plant', the keyword arguments of PeltierPlant; 'scope', parameters of the
+# SPIMMM such as tkp, tki, tcf or taw; 'schedule' and 'seconds', as for simulate; 'band', for the settling time.
+# returns the settings, the times, temperatures and pwm read, and the step responses measured by tempanal
+def scenario(settings):
+    scope = simscope(**settings.get('plant', {}))
+    for name, value in settings.get('scope', {}).items():
+        setattr(scope, name, value)
+    schedule = settings.get('schedule', [(0, 37)])
+    times, temps = simulate(scope, settings.get('seconds', 3600), schedule)
+    pwms = scope.hist.since('pwm', times[0])[1]
+    bounds = [int(np.searchsorted(times, times[0] + offset)) for offset, setpoint in sorted(schedule)]
+    bounds.append(len(times))
+    steps = []
+    for (offset, setpoint), first, last in zip(sorted(schedule), bounds[:-1], bounds[1:]):
+        step = tempanal.analysestep(times[first:last], temps[first:last], pwms[first:last], setpoint,
+                                    settings.get('band', 0.5))
+        if step is not None:
+            steps.append(step)
+    return {'settings': settings, 'times': times, 'temps': temps, 'pwms': pwms, 'steps': steps}
+
+
+def scenarios(settings, processes=None):
+    settings = list(settings)
+    if len(settings) < 2 or processes == 1:
+        return [scenario(one) for one in settings]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(scenario, settings)
+    finally:
+        pool.close()
+        pool.join()
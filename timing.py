@@ -0,0 +1,262 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library keeps the timing statistics of the loops that run the hardware, so that the
+# delay between a measurement and the action taken on it, the regularity of the loop, and the serial bus time that a
+# poll uses, can be reported. it also keeps the clock that timed loops run against, and waits for their deadlines.
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# math is used for the standard deviation
+# threading is used to guard the statistics, which are read from other threads
+# time is used to measure how long a poll has run and to wait
+
+import math
+import threading
+import time
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# objects ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# Stat - the running count, mean, deviation, minimum and maximum of one quantity
+#
+# LoopStats - the latency and period statistics of one loop
+#
+# PollStats - the round trip times and periods of a poll, and the bus time it has freed by polling less often
+#
+# Periodic - waits for the deadlines of a loop that runs at a fixed period, and keeps its statistics
+#
+# VolumeStats - the volumes sent, acknowledged, timed out and missed, their latency and the volumes per second
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# clock - the time in seconds from a clock that never goes backwards, for deadlines; only differences between its
+# readings mean anything
+#
+# sleepuntil - waits until a deadline on the clock, sleeping for most of the wait and spinning for the rest
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# SPIN - the default time in seconds before a deadline that sleepuntil spins rather than sleeps. a sleep can overrun
+# by the timer resolution of the OS, about 1ms on linux but up to 16ms on windows, so it should be at least that
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SPIN = 0.002
+
+# python 2 has no monotonic clock, so it falls back to the wall clock
+clock = getattr(time, 'monotonic', time.time)
+
+
+# deadlines ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# waiting for an absolute deadline, rather than sleeping for an interval, keeps the time lost to each wait from adding
+# up over a run. returns how late the wait ended, in seconds
+
+def sleepuntil(deadline, spin=SPIN):
+    while True:
+        left = deadline - clock()
+        if left <= 0:
+            return -left
+        if left > spin:
+            time.sleep(left - spin)
+
+
+# running statistics ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# values are folded in one at a time, so nothing is stored however long the loop runs
+
+class Stat:
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.sq = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.sq += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def std(self):
+        return math.sqrt(self.sq / (self.count - 1)) if self.count > 1 else 0.0
+
+    def summary(self, scale=1e3, unit='ms'):
+        if not self.count:
+            return 'no data'
+        return 'mean {0:.2f}{4} std {1:.2f}{4} min {2:.2f}{4} max {3:.2f}{4}'.format(
+            self.mean * scale, self.std() * scale, self.min * scale, self.max * scale, unit)
+
+
+# loop statistics ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# latency is the time from a measurement to the action taken on it, period the time between actions, and the jitter
+# of the loop is the standard deviation of its period. skipped counts the measurements that arrived but were not acted
+# on
+
+class LoopStats:
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latency = Stat()
+        self.period = Stat()
+        self.skipped = 0
+        self.last = None
+
+    def act(self, measured, acted):
+        with self.lock:
+            self.latency.add(acted - measured)
+            if self.last is not None:
+                self.period.add(acted - self.last)
+            self.last = acted
+
+    def skip(self, count=1):
+        with self.lock:
+            self.skipped += count
+
+    def jitter(self):
+        return self.period.std()
+
+    def report(self):
+        with self.lock:
+            return (self.name + ': ' + str(self.latency.count) + ' actions, ' + str(self.skipped) + ' skipped\n'
+                    + '  latency ' + self.latency.summary() + '\n'
+                    + '  period ' + self.period.summary() + ', jitter {0:.2f}ms'.format(self.jitter() * 1e3))
+
+
+# poll statistics ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the polls saved are those a fixed poll, waiting 'base' seconds after each round trip, would have sent over the same
+# time, less those that were sent, and the bus time freed is that many round trips at the mean round trip time
+
+class PollStats:
+
+    def __init__(self, name, base):
+        self.name = name
+        self.base = base
+        self.lock = threading.Lock()
+        self.rtt = Stat()
+        self.period = Stat()
+        self.start = time.time()
+
+    def poll(self, rtt, period):
+        with self.lock:
+            self.rtt.add(rtt)
+            self.period.add(period)
+
+    def freed(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            saved = max((now - self.start) / (self.base + self.rtt.mean) - self.rtt.count, 0.0)
+            return saved, saved * self.rtt.mean
+
+    def report(self):
+        saved, freed = self.freed()
+        with self.lock:
+            return (self.name + ': ' + str(self.rtt.count) + ' polls, ' + str(int(saved)) + ' saved, '
+                    + '{0:.2f}s of bus time freed\n'.format(freed)
+                    + '  round trip ' + self.rtt.summary() + '\n'
+                    + '  period ' + self.period.summary())
+
+
+# periodic loops ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the deadlines are whole periods from the first call to wait, so the time spent in the loop does not make it drift. if
+# the loop overruns so that deadlines are missed, policy 'skip' drops them and waits for the next one to come, counting
+# them as skipped, and 'catchup' runs the missed ones at once so that the number of ticks keeps up with the time. the
+# latency of stats is how late each tick was, and its jitter that of the period between ticks
+
+class Periodic:
+
+    def __init__(self, period, policy='skip', spin=SPIN, name='periodic'):
+        self.period = period
+        self.policy = policy
+        self.spin = spin
+        self.stats = LoopStats(name)
+        self.deadline = None
+        self.first = None
+
+    # returns the deadline of the tick
+    def wait(self):
+        if self.deadline is None:
+            self.deadline = clock()
+        sleepuntil(self.deadline, self.spin)
+        now = clock()
+        if self.first is None:
+            self.first = now
+        deadline = self.deadline
+        self.stats.act(deadline, now)
+        self.deadline += self.period
+        if self.policy == 'skip' and now > self.deadline:
+            missed = int((now - self.deadline) // self.period) + 1
+            self.deadline += missed * self.period
+            self.stats.skip(missed)
+        return deadline
+
+    # the ticks per second achieved since the first
+    def rate(self):
+        with self.stats.lock:
+            if self.stats.latency.count < 2:
+                return 0.0
+            return (self.stats.latency.count - 1) / (self.stats.last - self.first)
+
+    def report(self):
+        return self.stats.report() + '\n  rate {0:.2f}Hz of {1:.2f}Hz'.format(self.rate(), 1.0 / self.period)
+
+
+# volume statistics ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# latency is the time from writing a volume to its acknowledgement. the acknowledgements carry the count of volumes
+# the arduino has taken, so a jump in the count is a volume that was taken but whose acknowledgement was missed, such
+# as one that arrived after its timeout. the backlog is the volumes sent that are neither acknowledged nor timed out.
+# an acknowledgement whose write time is not known is counted without a latency
+
+class VolumeStats:
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latency = Stat()
+        self.acknowledged = 0
+        self.sent = 0
+        self.timedout = 0
+        self.missed = 0
+        self.count = None
+        self.start = clock()
+
+    def send(self, volumes=1):
+        with self.lock:
+            self.sent += volumes
+
+    # count is the arduino's count of volumes, None if it could not be read
+    def done(self, latency, count=None):
+        with self.lock:
+            self.acknowledged += 1
+            if latency is not None:
+                self.latency.add(latency)
+            if count is not None:
+                if self.count is not None and count > self.count + 1:
+                    self.missed += count - self.count - 1
+                self.count = count
+
+    def timeout(self, volumes=1):
+        with self.lock:
+            self.timedout += volumes
+
+    def backlog(self):
+        with self.lock:
+            return self.sent - self.acknowledged - self.timedout
+
+    def rate(self):
+        with self.lock:
+            elapsed = clock() - self.start
+            return self.acknowledged / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        rate = self.rate()
+        backlog = self.backlog()
+        with self.lock:
+            return (self.name + ': ' + str(self.acknowledged) + ' of ' + str(self.sent) + ' acknowledged, '
+                    + str(self.timedout) + ' timed out, ' + str(self.missed) + ' missed, ' + str(backlog)
+                    + ' outstanding, {0:.2f} volumes/s\n'.format(rate)
+                    + '  latency ' + self.latency.summary())
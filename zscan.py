@@ -0,0 +1,151 @@
+# this library was written for the Selective Plane Illumination Magnetic Manipulator Microscope [SPIMMM]
+# description of function: this library plans a z scan, a stack of slices from dlo to dup in steps of ste, all at once.
+# the stage position, mirror count, move time and frame trigger time of every slice are worked out together as numpy
+# arrays, and the commands that move to each slice are encoded once, so that running a volume only writes out bytes
+# that are ready. plans are cached by their parameters, so the same stack is only planned once. for example:
+#
+#   scan = zscan.cached(6.0, 6.3, 0.02, -4486.982, 6.1, 20, 10, 25)
+#   scan['dac'], scan['trigger']
+
+# libraries to import ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# collections holds the cache in the order the plans were used
+# numpy works out the plan
+# binproto encodes the moves as binary frames
+# motion looks up the move times when the stage has been calibrated
+
+import collections
+
+import numpy as np
+
+import binproto
+import motion
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# description of parameters
+#
+# constants ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# MAXDAC - the largest mirror count
+#
+# MAXPOS - the furthest the stage may be sent from zero, in mm
+#
+# SLOWDIST - a move to the first slice of at least this many mm is made in slow mode (STS), as in SPIMMM.stagecmd
+#
+# SLOWTIME - the shortest time in seconds that a move in slow mode takes
+#
+# CACHESIZE - the number of plans kept by cached
+#
+# functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# positions - the stage position of each slice
+#
+# counts - the mirror count that keeps each stage position in focus, as SPIMMM.stm, and which of them were clamped
+#
+# movetimes - the time each move takes, as SPIMMM.pau without a motion calibration, in seconds
+#
+# plan - works out a whole scan
+#
+# cached - as plan, but returns the same plan for the same parameters
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+MAXDAC = 4095
+
+MAXPOS = 6.495
+
+SLOWDIST = 0.010
+
+SLOWTIME = 2.5
+
+CACHESIZE = 16
+
+CACHE = collections.OrderedDict()
+
+
+# focus mapping ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the slices are spaced as the arduino spaces them, one more than the number of steps that fit between the limits
+
+def positions(dlo, dup, ste):
+    count = int(round(abs(dup - dlo) / ste)) + 1 if ste else 1
+    return np.round(dlo + np.sign(dup - dlo) * ste * np.arange(count), 6)
+
+
+def counts(pos, slp, posadj):
+    raw = ((np.asarray(pos, float) - posadj) * slp + MAXDAC).astype(int)
+    return np.clip(raw, 0, MAXDAC), (raw < 0) | (raw > MAXDAC)
+
+
+# smt is the time a move of ste takes in milliseconds, and longer moves take proportionally longer. slow marks the moves
+# made in slow mode
+def movetimes(distances, ste, smt, slow=False):
+    distances = np.abs(np.asarray(distances, float))
+    times = 0.001 * smt * distances / ste
+    return np.where(slow, np.maximum(times, SLOWTIME), times)
+
+
+# planning ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# the stage starts at 'start', or at the first slice, and the moves between slices are small moves (STA). if the tables
+# of a motion calibration are given, the mode and time of every move they cover are taken from them instead. each
+# slice is moved to once the frame before it has been exposed, and triggered once the move has settled, but no sooner
+# than frt milliseconds after the frame before it. times are in seconds from the first move. the plan holds:
+#   pos - stage positions in mm
+#   dac - mirror counts
+#   clipped - which mirror counts were clamped to the range of the mirror
+#   move - the time each move takes
+#   moveat - when each move is written
+#   trigger - when each frame is triggered
+#   length - when the last frame has been exposed
+#   moves - the encoded commands that move to each slice
+#   frame - the encoded frame trigger
+# returns None if a slice is out of the range of the stage
+
+def plan(dlo, dup, ste, slp, posadj, smt, exp, frt, start=None, cam=0, bin=False, tables=None):
+    pos = positions(dlo, dup, ste)
+    if np.any(np.abs(pos) > MAXPOS):
+        print('warning: position out of bounds')
+        return None
+    dac, clipped = counts(pos, slp, posadj)
+    if np.any(clipped):
+        print('warning: mirror out of range for ' + str(int(np.sum(clipped))) + ' slices')
+    previous = np.append(pos[0] if start is None else start, pos[:-1])
+    distances = np.abs(pos - previous)
+    slow = np.zeros(len(pos), bool)
+    slow[0] = distances[0] >= SLOWDIST
+    move = movetimes(distances, ste, smt, slow)
+    if tables:
+        modes = [motion.choose(tables, distance) for distance in distances]
+        for mode in set(modes) - set([None]):
+            chosen = np.array([each == mode for each in modes])
+            slow[chosen] = mode == 'STS'
+            move[chosen] = motion.movetime(tables[mode], distances[chosen])
+    # the gap between triggers is the exposure and the next move, or the frame period if that is longer
+    gaps = np.maximum(0.001 * exp + move[1:], 0.001 * frt)
+    trigger = move[0] + np.append(0.0, np.cumsum(gaps))
+    moveat = np.append(0.0, trigger[:-1] + 0.001 * exp)
+    moves = []
+    for position, count, isslow in zip(pos, dac, slow):
+        if bin and not isslow:
+            moves.append(binproto.encodemany([(binproto.DAC, [count]), (binproto.STA, [binproto.tonm(position)])]))
+        else:
+            mode = 'STS ' if isslow else 'STA '
+            moves.append(('DAC ' + str(int(count)) + '\r' + mode + str(float(position)) + '\r').encode('ascii'))
+    for array in (pos, dac, clipped, move, moveat, trigger):
+        array.setflags(write=False)
+    return {'pos': pos, 'dac': dac, 'clipped': clipped, 'move': move, 'moveat': moveat, 'trigger': trigger,
+            'length': float(trigger[-1] + 0.001 * exp), 'moves': tuple(moves),
+            'frame': ('FRM ' + str(int(cam)) + ' ' + str(int(exp)) + '\r').encode('ascii')}
+
+
+# the arrays of a cached plan are shared, so they are made read only
+def cached(dlo, dup, ste, slp, posadj, smt, exp, frt, start=None, cam=0, bin=False, tables=None):
+    key = (dlo, dup, ste, slp, posadj, smt, exp, frt, start, cam, bin, motion.key(tables))
+    if key in CACHE:
+        scan = CACHE.pop(key)
+    else:
+        scan = plan(*(key[:-1] + (tables,)))
+        if scan is None:
+            return None
+    CACHE[key] = scan
+    while len(CACHE) > CACHESIZE:
+        CACHE.popitem(last=False)
+    return scan